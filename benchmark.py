@@ -0,0 +1,422 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pygame
+
+from constants import (DT, ELASTIC, FMM_ORDER, G, HEIGHT, INELASTIC, MERGE, SOFTENING, THETA,
+                       WIDTH)
+from fmm import fmm_forces
+from linear_quadtree import IncrementalQuadtree, LinearQuadtree
+from main import Camera
+from parallel import ForcePool
+from particle import Particle, resolve_pairs
+from pm import pm_forces
+from renderer import draw_lod, draw_particles
+from scenarios import generate
+from worker import Snapshot
+from physics import (brute_force_forces, build_quadtree, calculate_forces, find_collision_pairs,
+                     generate_particles, handle_collisions, step, update_particles)
+
+SUITE_SIZES = [100, 1000, 10000, 100000]
+BRUTE_FORCE_LIMIT = 10000  # O(n^2) cases are skipped above this size
+REGRESSION_THRESHOLD = 0.2  # Fractional slowdown against the baseline that fails the run
+NOISE_FLOOR = 0.001  # Slowdowns smaller than this many seconds are timer noise
+MULTIPOLE_THETAS = [0.3, 0.5, 0.7, 1.0, 1.5, 2.0]
+REFERENCE_SAMPLE = 2000  # Particles whose forces are checked against brute force
+FMM_ORDERS = [2, 4, 6, 8, 10]
+FMM_VALIDATION_SIZE = 3000  # Small enough to check every particle against brute force
+FMM_SCENARIOS = ["uniform", "plummer", "galaxies"]  # Clustered inputs crowd the leaf cells
+PM_GRIDS = [64, 128, 256, 512]
+RENDER_ZOOMS = [0.1, 0.3, 1.0, 2.0]  # The GUI zoom slider's range
+CONSERVATION_TOLERANCE = 1e-9  # Relative energy/momentum change allowed per collision frame
+SETTLE_STEPS = 30  # Steps before the second collision timing, once the spawn has spread out
+
+def best_time(fn, repeat, setup=None):
+    # Best of repeat runs; setup() runs untimed before each one and its
+    # result is passed to fn
+    best = float("inf")
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        fn(state) if setup else fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def scenario(n):
+    # Seeded so every run times the same particles. The spread grows with n
+    # to keep the density of the default 1000-particle batch; at the default
+    # spread 100k particles would overlap ~1000 neighbours each.
+    random.seed(n)
+    return generate_particles(n, spread=100 * (n / 1000) ** 0.5)
+
+def bench_tree_build(sizes, repeat):
+    print(f"{'particles':>10} {'recursive (s)':>14} {'linear (s)':>11} {'speedup':>8}")
+    for n in sizes:
+        random.seed(n)
+        particles = generate_particles(n)
+        recursive = best_time(lambda: build_quadtree(particles, "recursive"), repeat)
+        linear = best_time(lambda: build_quadtree(particles, "linear"), repeat)
+        print(f"{n:>10} {recursive:>14.4f} {linear:>11.4f} {recursive / linear:>7.1f}x")
+
+def bench_parallel_scaling(sizes, repeat, max_workers):
+    print(f"{'particles':>10} {'workers':>8} {'time (s)':>9} {'speedup':>8}")
+    for n in sizes:
+        random.seed(n)
+        particles = generate_particles(n)
+        serial = best_time(lambda: calculate_forces(particles), repeat)
+        print(f"{n:>10} {'serial':>8} {serial:>9.4f} {1.0:>7.2f}x")
+        for workers in range(1, max_workers + 1):
+            pool = ForcePool(workers)
+            calculate_forces(particles, pool=pool)  # Warm up workers and shared blocks
+            elapsed = best_time(lambda: calculate_forces(particles, pool=pool), repeat)
+            pool.close()
+            print(f"{n:>10} {workers:>8} {elapsed:>9.4f} {serial / elapsed:>7.2f}x")
+
+def bench_tree_refit(sizes, steps):
+    # Drift particles without collisions so the particle set stays fixed
+    print(f"{'particles':>10} {'rebuild (s)':>12} {'refit (s)':>10} {'rebuilds':>9} {'moved/step':>11}")
+    for n in sizes:
+        random.seed(n)
+        particles = generate_particles(n)
+        cache = IncrementalQuadtree()
+        rebuild = 0.0
+        refit = 0.0
+        moved = 0
+        for _ in range(steps):
+            start = time.perf_counter()
+            build_quadtree(particles, "linear")
+            rebuild += time.perf_counter() - start
+            start = time.perf_counter()
+            cache.update(particles)
+            refit += time.perf_counter() - start
+            moved += cache.moved
+            calculate_forces(particles, tree=cache.tree)
+            update_particles(particles, DT)
+        print(f"{n:>10} {rebuild / steps:>12.5f} {refit / steps:>10.5f} "
+              f"{cache.rebuilds:>9} {moved / steps:>11.1f}")
+
+def bench_objects(sizes, repeat):
+    # The Particle object model: memory per instance (tracemalloc, including
+    # its float values) and elastic collisions per second, resolved one call
+    # per pair, with resolve_pairs, and on the arrays by handle_collisions
+    print(f"{'particles':>10} {'bytes/obj':>10} {'pairs':>7} {'per-call/s':>11} "
+          f"{'resolve_pairs/s':>16} {'arrays/s':>10}")
+    for n in sizes:
+        particles = scenario(n)
+        tracemalloc.start()
+        objects = [Particle(*values) for values in zip(
+            particles.x.tolist(), particles.y.tolist(), particles.vx.tolist(),
+            particles.vy.tolist(), particles.mass.tolist(), particles.radius.tolist())]
+        size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(objects)
+        tracemalloc.stop()
+        i, j = find_collision_pairs(particles.x, particles.y, particles.radius)
+        pairs = list(zip(i.tolist(), j.tolist()))
+
+        def per_call():
+            for a, b in pairs:
+                p = objects[a]
+                q = objects[b]
+                if p.collides_with(q):
+                    p.elastic_collide(q)
+        per_call_time = best_time(per_call, repeat)
+        batched_time = best_time(lambda: resolve_pairs(objects, i, j, ELASTIC), repeat)
+        arrays_time = best_time(lambda state: handle_collisions(state, ELASTIC), repeat,
+                                setup=particles.copy)
+        rate = lambda elapsed: len(pairs) / elapsed if elapsed else float("inf")
+        print(f"{n:>10} {size / n:>10.1f} {len(pairs):>7} {rate(per_call_time):>11.0f} "
+              f"{rate(batched_time):>16.0f} {rate(arrays_time):>10.0f}")
+
+def bench_collisions(sizes, repeat):
+    # One collision frame on the default (overlapping) spawn per mode, with
+    # a conservation check: elastic keeps kinetic energy, inelastic never
+    # gains any, and both keep momentum. Returns False if any check failed.
+    # The frame is timed again after SETTLE_STEPS steps, when the pairs
+    # that were already moving apart no longer need resolving.
+    print(f"{'particles':>10} {'mode':>10} {'pairs':>7} {'time (s)':>9} {'settled':>7} "
+          f"{'time (s)':>9} {'energy':>9} {'momentum':>9} {'check':>6}")
+    passed = True
+    for n in sizes:
+        for name, mode in (("elastic", ELASTIC), ("inelastic", INELASTIC)):
+            particles = generate_particles(n, seed=1)
+            i, _ = find_collision_pairs(particles.x, particles.y, particles.radius)
+            energy = lambda p: float((p.mass * (p.vx**2 + p.vy**2)).sum())
+            momentum = lambda p: np.array([(p.mass * p.vx).sum(), (p.mass * p.vy).sum()])
+            scale = float((particles.mass * np.hypot(particles.vx, particles.vy)).sum())
+            before_energy = energy(particles)
+            before_momentum = momentum(particles)
+            handle_collisions(particles, mode)
+            ratio = energy(particles) / before_energy
+            drift = float(np.abs(momentum(particles) - before_momentum).max()) / scale
+            ok = drift < CONSERVATION_TOLERANCE and (
+                abs(ratio - 1) < CONSERVATION_TOLERANCE if mode == ELASTIC
+                else ratio < 1 + CONSERVATION_TOLERANCE)
+            passed = passed and ok
+            elapsed = best_time(lambda state: handle_collisions(state, mode), repeat,
+                                setup=lambda: generate_particles(n, seed=1))
+            for _ in range(SETTLE_STEPS):
+                step(particles, DT, mode)
+            settled_pairs, _ = find_collision_pairs(particles.x, particles.y, particles.radius)
+            settled = best_time(lambda state: handle_collisions(state, mode), repeat,
+                                setup=particles.copy)
+            print(f"{n:>10} {name:>10} {len(i):>7} {elapsed:>9.4f} {len(settled_pairs):>7} "
+                  f"{settled:>9.4f} {ratio:>9.4f} {drift:>9.1e} {'ok' if ok else 'FAIL':>6}")
+    return passed
+
+def bench_render(sizes, repeat, zooms):
+    # Frame draw time for a Plummer sphere on an offscreen surface, every
+    # particle drawn vs quadtree level of detail, at several camera zooms
+    print(f"{'particles':>10} {'zoom':>5} {'particles (s)':>14} {'lod (s)':>9} {'speedup':>8}")
+    screen = pygame.Surface((WIDTH, HEIGHT))
+    for n in sizes:
+        particles = generate("plummer", n, seed=n)
+        full = Snapshot()
+        full.fill(particles, 0)
+        lod = Snapshot()
+        lod.fill(particles, 0, LinearQuadtree(particles.x, particles.y, particles.mass))
+        for zoom in zooms:
+            camera = Camera(WIDTH / 2, HEIGHT / 2, zoom)
+
+            def draw(snapshot=full):
+                screen.fill((0, 0, 0))
+                draw_particles(screen, camera, snapshot.x[:n], snapshot.y[:n],
+                               snapshot.radius[:n], snapshot.color[:n])
+
+            def draw_nodes(snapshot=lod):
+                screen.fill((0, 0, 0))
+                draw_lod(screen, camera, snapshot.x[:n], snapshot.y[:n], snapshot.radius[:n],
+                         snapshot.color[:n], snapshot.nodes)
+            plain = best_time(draw, repeat)
+            nodes = best_time(draw_nodes, repeat)
+            print(f"{n:>10} {zoom:>5g} {plain:>14.5f} {nodes:>9.5f} {plain / nodes:>7.2f}x",
+                  flush=True)
+
+def peak_memory(fn):
+    # Peak traced allocation of one untimed run, in MiB
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+def reference_forces(particles, sample):
+    # Brute-force forces on the sample, a few rows at a time so that large n
+    # does not need sample x n temporaries
+    n = len(particles)
+    exact_x = np.zeros(n)
+    exact_y = np.zeros(n)
+    rows = max(1, BRUTE_FORCE_LIMIT * 1000 // n)
+    for lo in range(0, len(sample), rows):
+        brute_force_forces(particles.x, particles.y, particles.mass, G, SOFTENING,
+                           exact_x, exact_y, targets=sample[lo:lo + rows])
+    return exact_x[sample], exact_y[sample]
+
+def relative_error(fx, fy, exact_x, exact_y):
+    return np.hypot(fx - exact_x, fy - exact_y) / np.hypot(exact_x, exact_y)
+
+def bench_fmm(sizes, repeat, orders, scenarios):
+    # Validation: every particle of a small system against brute force, per
+    # expansion order. Crossover: FMM against the batched Barnes-Hut walk at
+    # the default THETA and at theta 0.5, per scenario, errors on a sample.
+    # "uniform" is the density-preserving box used by the other cases; the
+    # clustered ones keep their default scale, so their cores grow denser
+    particles = scenario(FMM_VALIDATION_SIZE)
+    everyone = np.arange(len(particles))
+    exact_x, exact_y = reference_forces(particles, everyone)
+    print(f"validation, {len(particles)} particles")
+    print(f"{'order':>6} {'time (s)':>9} {'median err':>11} {'max err':>9}")
+    for order in orders:
+        elapsed = best_time(lambda: fmm_forces(particles.x, particles.y, particles.mass, G,
+                                               SOFTENING, order), repeat)
+        fx, fy = fmm_forces(particles.x, particles.y, particles.mass, G, SOFTENING, order)
+        error = relative_error(fx, fy, exact_x, exact_y)
+        print(f"{order:>6} {elapsed:>9.4f} {np.median(error):>11.2e} {error.max():>9.2e}")
+
+    print(f"\n{'scenario':>9} {'particles':>10} {'method':>14} {'time (s)':>9} {'median err':>11} "
+          f"{'peak MiB':>9}")
+    for name, n in ((name, n) for name in scenarios for n in sizes):
+        particles = scenario(n) if name == "uniform" else generate(name, n, seed=n)
+        sample = np.random.default_rng(n).choice(n, min(n, REFERENCE_SAMPLE), replace=False)
+        exact_x, exact_y = reference_forces(particles, sample)
+        results = []
+        for theta in (THETA, 0.5):
+            def barnes_hut(theta=theta):
+                tree = build_quadtree(particles, "linear")
+                fx = np.empty(n)
+                fy = np.empty(n)
+                fx[tree.order], fy[tree.order] = tree.batched_forces(theta, G, SOFTENING)
+                return fx, fy
+            results.append((f"bh theta {theta:g}", best_time(barnes_hut, repeat), barnes_hut(),
+                            peak_memory(barnes_hut)))
+        fmm = lambda: fmm_forces(particles.x, particles.y, particles.mass, G, SOFTENING)
+        results.append((f"fmm order {FMM_ORDER}", best_time(fmm, repeat), fmm(), peak_memory(fmm)))
+        for method, elapsed, (fx, fy), peak in results:
+            error = relative_error(fx[sample], fy[sample], exact_x, exact_y)
+            print(f"{name:>9} {n:>10} {method:>14} {elapsed:>9.4f} {np.median(error):>11.2e} "
+                  f"{peak:>9.1f}", flush=True)
+
+def bench_pm(sizes, repeat, grids):
+    # PM and P3M per mesh resolution against Barnes-Hut at the default THETA
+    # and FMM, errors on a sample checked against brute force
+    print(f"{'particles':>10} {'method':>14} {'time (s)':>9} {'median err':>11} {'p99 err':>9}")
+    for n in sizes:
+        particles = scenario(n)
+        sample = np.random.default_rng(n).choice(n, min(n, REFERENCE_SAMPLE), replace=False)
+        exact_x, exact_y = reference_forces(particles, sample)
+        results = []
+        for cells in grids:
+            for p3m in (False, True):
+                mesh = lambda cells=cells, p3m=p3m: pm_forces(
+                    particles.x, particles.y, particles.mass, G, SOFTENING, cells, p3m=p3m)
+                name = f"{'p3m' if p3m else 'pm'} {cells}"
+                results.append((name, best_time(mesh, repeat), mesh()))
+
+        def barnes_hut():
+            tree = build_quadtree(particles, "linear")
+            fx = np.empty(n)
+            fy = np.empty(n)
+            fx[tree.order], fy[tree.order] = tree.batched_forces(THETA, G, SOFTENING)
+            return fx, fy
+        results.append((f"bh theta {THETA:g}", best_time(barnes_hut, repeat), barnes_hut()))
+        fmm = lambda: fmm_forces(particles.x, particles.y, particles.mass, G, SOFTENING)
+        results.append((f"fmm order {FMM_ORDER}", best_time(fmm, repeat), fmm()))
+        for name, elapsed, (fx, fy) in results:
+            error = relative_error(fx[sample], fy[sample], exact_x, exact_y)
+            print(f"{n:>10} {name:>14} {elapsed:>9.4f} {np.median(error):>11.2e} "
+                  f"{np.percentile(error, 99):>9.2e}", flush=True)
+
+def bench_multipole(sizes, repeat, thetas):
+    # Accuracy against brute force vs traversal time for monopole and
+    # quadrupole trees; * marks the Pareto front (no other setting is both
+    # faster and more accurate by median error)
+    print(f"{'particles':>10} {'moments':>10} {'theta':>6} {'time (s)':>9} "
+          f"{'median err':>11} {'p99 err':>9}")
+    for n in sizes:
+        particles = scenario(n)
+        sample = np.random.default_rng(n).choice(n, min(n, REFERENCE_SAMPLE), replace=False)
+        exact_x, exact_y = reference_forces(particles, sample)
+        rows = []
+        for quadrupole in (False, True):
+            tree = LinearQuadtree(particles.x, particles.y, particles.mass, quadrupole=quadrupole)
+            rank = np.empty(n, dtype=np.int64)
+            rank[tree.order] = np.arange(n)
+            for theta in thetas:
+                elapsed = best_time(lambda: tree.batched_forces(theta, G, SOFTENING), repeat)
+                fx, fy = tree.batched_forces(theta, G, SOFTENING, rank[sample])
+                error = relative_error(fx, fy, exact_x, exact_y)
+                rows.append(("quadrupole" if quadrupole else "monopole", theta, elapsed,
+                             np.median(error), np.percentile(error, 99)))
+        for kind, theta, elapsed, median, p99 in rows:
+            front = not any(t < elapsed and m < median for _, _, t, m, _ in rows)
+            print(f"{n:>10} {kind:>10} {theta:>6.2f} {elapsed:>9.4f} {median:>11.2e} "
+                  f"{p99:>9.2e}{' *' if front else ''}")
+
+def suite_cases(particles):
+    # Case name -> (setup, timed function); setups hand each run a fresh copy
+    # because collisions and steps change the particles
+    n = len(particles)
+    cases = {
+        "tree-build": (None, lambda: build_quadtree(particles)),
+        "bh-force": (particles.copy, lambda p: calculate_forces(p)),
+    }
+    if n <= BRUTE_FORCE_LIMIT:
+        cases["brute-force"] = (particles.copy, lambda p: calculate_forces(p, use_barnes_hut=False))
+    for name, mode in (("elastic", ELASTIC), ("merge", MERGE), ("inelastic", INELASTIC)):
+        cases["collisions-" + name] = (particles.copy, lambda p, mode=mode: handle_collisions(p, mode))
+    cases["full-step"] = (particles.copy, lambda p: step(p, DT, ELASTIC))
+    return cases
+
+def run_suite(sizes, repeat):
+    results = {}
+    for n in sizes:
+        particles = scenario(n)
+        for name, (setup, fn) in suite_cases(particles).items():
+            elapsed = best_time(fn, repeat, setup)
+            results[f"{name}/{n}"] = elapsed
+            print(f"{name + '/' + str(n):>28} {elapsed:>10.5f}s", flush=True)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+def compare(current, baseline, threshold):
+    # Cases slower than the baseline by more than threshold; cases missing
+    # from either side are ignored
+    regressions = []
+    for case, elapsed in current["results"].items():
+        before = baseline["results"].get(case)
+        if before and elapsed > before * (1 + threshold) and elapsed - before > NOISE_FLOOR:
+            regressions.append((case, before, elapsed))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Physics micro-benchmarks")
+    parser.add_argument("case", choices=["tree-build", "parallel-scaling", "tree-refit", "multipole",
+                                         "fmm", "pm", "objects", "collisions", "render", "suite"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--output", help="suite: write results JSON here")
+    parser.add_argument("--baseline", help="suite: compare against this results JSON")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--thetas", type=float, nargs="+", default=MULTIPOLE_THETAS,
+                        help="multipole: opening angles to sweep")
+    parser.add_argument("--orders", type=int, nargs="+", default=FMM_ORDERS,
+                        help="fmm: expansion orders to validate")
+    parser.add_argument("--scenarios", nargs="+", default=FMM_SCENARIOS,
+                        choices=["uniform", "plummer", "disk", "galaxies"],
+                        help="fmm: particle distributions for the crossover table")
+    parser.add_argument("--zooms", type=float, nargs="+", default=RENDER_ZOOMS,
+                        help="render: camera zoom levels")
+    parser.add_argument("--grids", type=int, nargs="+", default=PM_GRIDS,
+                        help="pm: mesh cells per side")
+    args = parser.parse_args()
+    if args.sizes is None:
+        args.sizes = SUITE_SIZES if args.case == "suite" else [1000, 10000, 100000]
+    if args.case == "suite":
+        current = run_suite(args.sizes, args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(current, baseline, args.threshold)
+            for case, before, after in regressions:
+                print(f"REGRESSION {case}: {before:.5f}s -> {after:.5f}s ({after / before - 1:+.0%})")
+            if regressions:
+                sys.exit(1)
+    elif args.case == "tree-build":
+        bench_tree_build(args.sizes, args.repeat)
+    elif args.case == "parallel-scaling":
+        bench_parallel_scaling(args.sizes, args.repeat, args.max_workers)
+    elif args.case == "tree-refit":
+        bench_tree_refit(args.sizes, args.steps)
+    elif args.case == "multipole":
+        bench_multipole(args.sizes, args.repeat, args.thetas)
+    elif args.case == "fmm":
+        bench_fmm(args.sizes, args.repeat, args.orders, args.scenarios)
+    elif args.case == "pm":
+        bench_pm(args.sizes, args.repeat, args.grids)
+    elif args.case == "objects":
+        bench_objects(args.sizes, args.repeat)
+    elif args.case == "collisions":
+        if not bench_collisions(args.sizes, args.repeat):
+            sys.exit(1)
+    elif args.case == "render":
+        bench_render(args.sizes, args.repeat, args.zooms)
+
+if __name__ == "__main__":
+    main()
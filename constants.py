@@ -7,6 +7,7 @@ G = 6.67430e-11 * 1e-6
 ELASTIC = 0
 MERGE = 1
 INELASTIC = 2
+INELASTIC_RESTITUTION = 0.5
 
 # Default particle properties
 DEFAULT_MASS = 1.0
@@ -16,11 +17,35 @@ DEFAULT_RADIUS = 5.0
 DT = 0.016  # Time step (approx 60 FPS)
 SOFTENING = 1.0  # Softening parameter for gravity
 
+# Simulation domain: "open", "reflective" or "periodic", a square of
+# DOMAIN_SIZE centred on the screen. Particles leaving an open domain are
+# kept ("keep"), removed ("evict") or merged into a far-field aggregate ("park").
+DOMAIN_MODE = "open"
+DOMAIN_ESCAPE = "keep"
+DOMAIN_SIZE = 4000.0
+
+# Rows per block in vectorized brute-force gravity (bounds temporary memory)
+BRUTE_FORCE_CHUNK = 1024
+
+# Energy diagnostics: pair terms per block (each temporary is 8 bytes per
+# term), and above ENERGY_SAMPLE particles the potential is estimated from
+# that many rows
+ENERGY_BLOCK = 1 << 21
+ENERGY_SAMPLE = 4096
+
+# Block timesteps: accuracy parameter and deepest level (dt / 2^level)
+BLOCK_ETA = 0.025
+BLOCK_MAX_LEVEL = 6
+
 # Screen settings
 WIDTH = 800
 HEIGHT = 600
 FPS = 60
 
+# Rendering: particles below this on-screen radius are drawn as single pixels
+PIXEL_RADIUS = 1.0
+LOD_PIXELS = 2.0  # Quadtree nodes smaller than this on screen are drawn as one splat
+
 # Camera settings
 ZOOM_SPEED = 0.1
 PAN_SPEED = 1.0
@@ -30,6 +55,46 @@ MAX_ZOOM = 10.0
 # Barnes-Hut theta (increased for faster approximations)
 THETA = 2.0
 
+# Quadtree backend: "recursive" (Quadtree objects) or "linear" (Morton-sorted arrays)
+TREE_BACKEND = "linear"
+QUADTREE_LEAF_SIZE = 8  # Max particles per linear quadtree leaf
+BH_BATCH_SIZE = 4096  # Particles traversed together by the batched Barnes-Hut walk
+REFIT_MARGIN = 1.5  # Root box scale for incrementally refitted trees
+REFIT_IMBALANCE = 4  # Rebuild once a leaf holds this many times QUADTREE_LEAF_SIZE
+QUADRUPOLE = False  # Also store second moments in linear tree nodes for a sharper far field
+FORCE_METHOD = "barnes_hut"  # "barnes_hut", "fmm", "pm", "p3m" or "brute_force"
+FMM_ORDER = 6  # Total degree of the FMM multipole and local expansions
+FMM_LEAF_SIZE = 32  # Target mean particles per FMM leaf cell
+FMM_EXTRA_LEVELS = 3  # Further FMM grid refinements allowed for clustered particles
+PM_GRID = 256  # Particle-mesh cells per side (padded to twice that for open boundaries)
+P3M_SPLIT = 1.25  # P3M long/short-range split radius, in mesh cells
+P3M_CUTOFF = 4.5  # P3M short-range cutoff, in split radii
+P3M_PAIR_BATCH = 1 << 20  # Candidate pairs per P3M short-range chunk
+P3M_FIRST_LEAVES = 64  # Tree leaves in the first P3M chunk, before its pair count is known
+
+# Parallel force evaluation (linear backend only); 0 keeps everything in-process
+FORCE_WORKERS = 0
+CHUNKS_PER_WORKER = 4  # Morton ranges per worker, for load balancing
+MORTON_BITS = 16  # Quantization bits per axis, also the max linear tree depth
+
+# Profiling
+PROFILE_WINDOW = 300  # Frames kept for the rolling percentiles
+
+# Time-budgeted force scheduling
+FORCE_TIME_LIMIT = 0.008  # Seconds per step the interactive worker spends on forces
+SCHEDULE_ORDER = "round_robin"  # Or "priority": stale, strongly accelerated particles first
+MAX_THETA = 4.0  # Coarsest opening angle the scheduler falls back to
+THETA_STEP = 1.25  # Factor theta is coarsened or refined by per step
+ACCURACY_SAMPLES = 32  # Particles checked against brute force per step, 0 to disable
+
+# Ensemble sweeps (ensemble.py)
+ENSEMBLE_MEMORY_LIMIT = 2048  # Address space per worker process in MiB, 0 for no limit
+ENSEMBLE_TASKS_PER_CHILD = 4  # Runs before a worker process is replaced
+
+# Snapshots
+CHECKPOINT_PATH = "checkpoint.nbody"  # Saved with F5, restored with F9
+RECORD_EVERY = 1  # Physics steps between recorded trajectory frames
+
 # Colors
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
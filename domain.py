@@ -0,0 +1,107 @@
+import numpy as np
+
+from constants import DOMAIN_ESCAPE, DOMAIN_MODE, DOMAIN_SIZE, G, HEIGHT, SOFTENING, WIDTH
+
+DOMAIN_MODES = ("open", "reflective", "periodic")
+ESCAPE_MODES = ("keep", "evict", "park")
+
+class Domain:
+    # The region particles live in: a square box of side size.
+    # "reflective" bounces particles off the walls, "periodic" wraps them
+    # around a torus with minimum-image gravity and collisions, and "open"
+    # lets them leave. What happens to those is up to escape: "keep" them
+    # (trees then fit the particles, as without a domain), "evict" them, or
+    # "park" them in one far-field aggregate that keeps their mass and
+    # momentum and still pulls on the rest as a softened point mass. In all
+    # other cases the tree root box is the domain box, so tree depth and
+    # per-step cost stay bounded however far the system spreads.
+    def __init__(self, mode=DOMAIN_MODE, size=DOMAIN_SIZE, center_x=WIDTH/2, center_y=HEIGHT/2,
+                 escape=DOMAIN_ESCAPE):
+        if mode not in DOMAIN_MODES:
+            raise ValueError(f"unknown domain mode {mode!r}, expected one of {DOMAIN_MODES}")
+        if escape not in ESCAPE_MODES:
+            raise ValueError(f"unknown escape mode {escape!r}, expected one of {ESCAPE_MODES}")
+        self.mode = mode
+        self.escape = escape
+        self.min_x = center_x - size / 2
+        self.min_y = center_y - size / 2
+        self.size = size
+        self.escaped = 0  # Particles evicted or parked so far
+        self.parked_mass = 0.0
+        self.parked_x = center_x
+        self.parked_y = center_y
+        self.parked_vx = 0.0
+        self.parked_vy = 0.0
+
+    @property
+    def box(self):
+        return self.min_x, self.min_y, self.size
+
+    @property
+    def period(self):
+        return self.size if self.mode == "periodic" else None
+
+    def tree_box(self):
+        # Fixed root box for trees, or None to fit them to the particles
+        if self.mode == "open" and self.escape == "keep":
+            return None
+        return self.box
+
+    def confine(self, particles):
+        # Wrap (periodic) or reflect (reflective) positions into the box;
+        # cheap and idempotent, so it can run before every force pass
+        if self.mode == "periodic":
+            for pos, lo in ((particles.x, self.min_x), (particles.y, self.min_y)):
+                pos -= lo
+                np.mod(pos, self.size, out=pos)
+                pos[pos >= self.size] = 0.0  # mod of a tiny negative can round up to size
+                pos += lo
+        elif self.mode == "reflective":
+            for pos, vel, lo in ((particles.x, particles.vx, self.min_x),
+                                 (particles.y, particles.vy, self.min_y)):
+                hi = lo + self.size
+                below = pos < lo
+                pos[below] = 2 * lo - pos[below]
+                vel[below] = np.abs(vel[below])
+                above = pos > hi
+                pos[above] = 2 * hi - pos[above]
+                vel[above] = -np.abs(vel[above])
+                # Anything faster than the box in one step stops at the wall
+                np.clip(pos, lo, hi, out=pos)
+
+    def remove_escaped(self, particles):
+        # Open domains: evict or park particles outside the box. Returns
+        # whether any were removed.
+        if self.mode != "open" or self.escape == "keep" or not len(particles):
+            return False
+        x, y = particles.x, particles.y
+        out = np.flatnonzero((x < self.min_x) | (x >= self.min_x + self.size) |
+                             (y < self.min_y) | (y >= self.min_y + self.size))
+        if not len(out):
+            return False
+        if self.escape == "park":
+            mass = particles.mass[out]
+            total = self.parked_mass + mass.sum()
+            for name, values in (("parked_x", x[out]), ("parked_y", y[out]),
+                                 ("parked_vx", particles.vx[out]), ("parked_vy", particles.vy[out])):
+                merged = (getattr(self, name) * self.parked_mass + (mass * values).sum()) / total
+                setattr(self, name, merged)
+            self.parked_mass = total
+        self.escaped += len(out)
+        particles.remove_many(out)
+        return True
+
+    def far_field(self, particles, dt, softening=SOFTENING):
+        # The parked aggregate's pull, applied as a separate velocity kick so
+        # that stale or partial force passes never count it twice. The
+        # aggregate itself coasts; the particles' pull on it is neglected.
+        if not self.parked_mass:
+            return
+        dx = self.parked_x - particles.x
+        dy = self.parked_y - particles.y
+        dist_sq = dx*dx + dy*dy + softening
+        scale = G * self.parked_mass / (dist_sq * np.sqrt(dist_sq)) * dt
+        particles.vx += scale * dx
+        particles.vy += scale * dy
+        self.parked_x += self.parked_vx * dt
+        self.parked_y += self.parked_vy * dt
@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from constants import (DT, ENSEMBLE_MEMORY_LIMIT, ENSEMBLE_TASKS_PER_CHILD, FORCE_METHOD,
+                       SOFTENING, THETA)
+from headless import COLLISION_MODES, run
+from physics import FORCE_METHODS, INTEGRATORS
+from scenarios import SCENARIOS
+
+# Parameter sweeps: every combination of the grid is one independent
+# headless run in a worker process. Each finished run appends one JSON line
+# (its parameters and summary metrics) to the results file, and runs
+# already recorded there are skipped, so an interrupted sweep resumes where
+# it stopped. Runs that raised are recorded with an "error" and retried on
+# resume. Must never import pygame.
+
+# Swept parameters; everything else is fixed for the whole sweep
+GRID_PARAMETERS = ("theta", "softening", "collision_mode", "count", "seed")
+
+def expand_grid(grid, fixed):
+    # One parameter dict per combination, in a stable order
+    names = [name for name in GRID_PARAMETERS if name in grid]
+    return [dict(fixed, **dict(zip(names, values)))
+            for values in itertools.product(*(grid[name] for name in names))]
+
+def run_key(params):
+    return json.dumps(params, sort_keys=True)
+
+def completed_runs(path):
+    # Keys of the successful runs in a results file. A line cut short by an
+    # interrupted sweep is dropped from the file so appending stays valid.
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb") as f:
+        data = f.read()
+    complete = data.rfind(b"\n") + 1
+    if complete < len(data):
+        os.truncate(path, complete)
+    for line in data[:complete].splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if "error" not in result:
+            done.add(run_key(result["params"]))
+    return done
+
+def _limit_memory(limit):
+    # Worker initializer: cap the address space so one runaway run fails
+    # with MemoryError instead of taking the machine down
+    if resource is not None and limit:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def run_one(params, energy=True):
+    # energy: measure the energy drift (None in the result otherwise); not
+    # part of the run's parameters, so toggling it does not redo runs
+    try:
+        stats = run(params["count"], params["seed"], params["collision_mode"],
+                    params["integrator"], params["steps"], dt=params["dt"], theta=params["theta"],
+                    scenario=params["scenario"], method=params["method"],
+                    softening=params["softening"], energy=energy)
+    except Exception as exc:  # MemoryError included; the sweep goes on
+        return {"params": params, "error": repr(exc)}
+    return {
+        "params": params,
+        "steps_per_sec": stats["steps_per_sec"],
+        "elapsed": stats["elapsed"],
+        "energy_drift": stats["energy_drift"],
+        "merges": stats["merges"],
+        "particles": stats["particles"],
+    }
+
+def sweep(runs, output, workers=None, memory_limit=ENSEMBLE_MEMORY_LIMIT,
+          tasks_per_child=ENSEMBLE_TASKS_PER_CHILD, energy=True):
+    # Runs the parameter dicts not yet in output across a process pool and
+    # yields each result as it is appended. memory_limit is in MiB.
+    done = completed_runs(output)
+    pending = [params for params in runs if run_key(params) not in done]
+    if not pending:
+        return
+    limit = memory_limit * 1024 * 1024
+    with open(output, "a") as results, ProcessPoolExecutor(
+            workers, initializer=_limit_memory, initargs=(limit,),
+            max_tasks_per_child=tasks_per_child) as executor:
+        futures = [executor.submit(run_one, params, energy) for params in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+            yield result
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a grid of headless simulations in parallel")
+    parser.add_argument("output", help="JSON-lines results file; finished runs in it are skipped")
+    parser.add_argument("--theta", type=float, nargs="+", default=[THETA])
+    parser.add_argument("--softening", type=float, nargs="+", default=[SOFTENING])
+    parser.add_argument("--collision-mode", choices=sorted(COLLISION_MODES), nargs="+",
+                        default=["elastic"])
+    parser.add_argument("--count", type=int, nargs="+", default=[1000])
+    parser.add_argument("--seed", type=int, nargs="+", default=[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="uniform")
+    parser.add_argument("--integrator", choices=sorted(INTEGRATORS), default="euler")
+    parser.add_argument("--method", choices=FORCE_METHODS, default=FORCE_METHOD)
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--dt", type=float, default=DT)
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--memory-limit", type=int, default=ENSEMBLE_MEMORY_LIMIT,
+                        help="address space per worker in MiB, 0 for no limit")
+    parser.add_argument("--tasks-per-child", type=int, default=ENSEMBLE_TASKS_PER_CHILD,
+                        help="runs before a worker process is replaced")
+    parser.add_argument("--no-energy", action="store_true",
+                        help="skip the energy drift measurement")
+    args = parser.parse_args()
+    grid = {name: getattr(args, name) for name in GRID_PARAMETERS}
+    fixed = {"scenario": args.scenario, "integrator": args.integrator, "method": args.method,
+             "steps": args.steps, "dt": args.dt}
+    runs = expand_grid(grid, fixed)
+    done = completed_runs(args.output)
+    remaining = sum(run_key(params) not in done for params in runs)
+    print(f"{len(runs)} runs, {remaining} to go")
+    try:
+        for k, result in enumerate(sweep(runs, args.output, args.workers, args.memory_limit,
+                                         args.tasks_per_child, not args.no_energy), 1):
+            swept = ", ".join(f"{name}={result['params'][name]}" for name in GRID_PARAMETERS)
+            if "error" in result:
+                print(f"[{k}] {swept}: {result['error']}")
+            else:
+                drift = result["energy_drift"]
+                drift = "off" if drift is None else f"{drift:.2e}"
+                print(f"[{k}] {swept}: {result['steps_per_sec']:.1f} steps/sec, "
+                      f"energy drift {drift}, {result['merges']} merges")
+    except BrokenProcessPool:
+        # A worker died outright (e.g. killed by the OS); finished runs are saved
+        raise SystemExit(f"a worker process died; rerun to resume the sweep from {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import math
+
+import numpy as np
+
+from constants import BH_BATCH_SIZE, FMM_EXTRA_LEVELS, FMM_LEAF_SIZE, FMM_ORDER, MORTON_BITS
+from linear_quadtree import _compact_bits, _ramp, _spread_bits, root_box
+
+# Fast multipole method for the simulation's kernel. Gravity here is the 3D
+# 1/r potential restricted to the plane, not the 2D logarithmic one, so the
+# classic analytic expansions in z do not apply. Instead, with z = x + iy,
+#     1/|z - w| = sum_kl a_k a_l w^k conj(w)^l z^(-k-1/2) conj(z)^(-l-1/2)
+# with a_k = binom(2k, k) / 4^k, a bivariate expansion in z and conj(z).
+# Multipole moments are M_kl = sum m w^k conj(w)^l and local coefficients
+# L_nm describe psi(c + t) = sum L_nm t^n conj(t)^m, both truncated at total
+# degree k + l <= order. The field is grad psi = 2 d psi / d conj(z).
+#
+# Cells are the levels of the same Morton decomposition as LinearQuadtree
+# (same root box) down to one leaf level. Only occupied cells are stored:
+# each level is a sorted array of Morton keys with one row of coefficients
+# per key, so memory grows with the particles, not with 4^level. A parent's
+# key is its children's key >> 2, and neighbours are found by searchsorted.
+# Moments are stored normalized by the cell size, which makes the M2M, M2L
+# and L2L operators identical on every level, so they are built once per
+# order. Adjacent leaf cells interact directly with the softened kernel;
+# farther cells use the unsoftened expansion, whose relative error from the
+# missing softening is below softening / (2 * leaf cell size^2).
+
+_operators = {}  # order -> (k, l, M2M, L2L, M2L by offset)
+
+def _terms(order):
+    # Exponent pairs (k, l) with k + l <= order, by total degree
+    k = [a for total in range(order + 1) for a in range(total + 1)]
+    l = [total - a for total in range(order + 1) for a in range(total + 1)]
+    return np.array(k), np.array(l)
+
+def _shift(k, l, delta, scale, upward):
+    # M2M (upward) or L2L matrix for a child whose centre is delta (in parent
+    # cell sizes) from the parent's; rows are outputs, columns inputs
+    P = len(k)
+    op = np.zeros((P, P), dtype=complex)
+    for row in range(P):
+        for col in range(P):
+            if upward:
+                (hi_k, hi_l), (lo_k, lo_l) = (k[row], l[row]), (k[col], l[col])
+                power = lo_k + lo_l
+            else:
+                (hi_k, hi_l), (lo_k, lo_l) = (k[col], l[col]), (k[row], l[row])
+                power = lo_k + lo_l + 1
+            if lo_k <= hi_k and lo_l <= hi_l:
+                op[row, col] = (math.comb(hi_k, lo_k) * math.comb(hi_l, lo_l) *
+                                delta ** (hi_k - lo_k) * np.conj(delta) ** (hi_l - lo_l) *
+                                scale ** power)
+    return op
+
+def operators(order):
+    if order in _operators:
+        return _operators[order]
+    k, l = _terms(order)
+    a = np.array([math.comb(2 * i, i) / 4**i for i in range(order + 1)])
+    # beta[k, n] = binom(-k - 1/2, n)
+    beta = np.ones((order + 1, order + 1))
+    for i in range(order + 1):
+        for n in range(1, order + 1):
+            beta[i, n] = beta[i, n - 1] * (-i - 0.5 - (n - 1)) / n
+    # coupling[(n, m), (k, l)] = a_k a_l beta(k, n) beta(l, m)
+    coupling = a[k][None, :] * a[l][None, :] * beta[k[None, :], k[:, None]] * beta[l[None, :], l[:, None]]
+    up_power = k[None, :] + k[:, None]
+    down_power = l[None, :] + l[:, None]
+
+    children = {}
+    for cx in (0, 1):
+        for cy in (0, 1):
+            delta = complex(cx - 0.5, cy - 0.5) / 2
+            children[cx, cy] = (_shift(k, l, delta, 0.5, True), _shift(k, l, delta, 0.5, False))
+    m2l = {}
+    for ox in range(-3, 4):
+        for oy in range(-3, 4):
+            if max(abs(ox), abs(oy)) < 2:
+                continue
+            # Source cell at target + (ox, oy); u = cell size / (target - source)
+            u = -1 / complex(ox, oy)
+            m2l[ox, oy] = abs(u) * coupling * u ** up_power * np.conj(u) ** down_power
+    _operators[order] = (k, l, children, m2l)
+    return _operators[order]
+
+def _key(ix, iy):
+    return _spread_bits(ix) | (_spread_bits(iy) << 1)
+
+def leaf_level(x, y, min_x, min_y, size, leaf_size=FMM_LEAF_SIZE):
+    # Start at the shallowest level with at most leaf_size particles per cell
+    # on average, then refine while the cell around a typical particle is
+    # crowded (clustered systems), up to FMM_EXTRA_LEVELS deeper
+    n = len(x)
+    level = 2
+    while level < MORTON_BITS and n > leaf_size * 4**level:
+        level += 1
+    for _ in range(FMM_EXTRA_LEVELS):
+        side = 1 << level
+        ix = np.clip(((x - min_x) / size * side).astype(np.int64), 0, side - 1)
+        iy = np.clip(((y - min_y) / size * side).astype(np.int64), 0, side - 1)
+        occupancy = np.unique(_key(ix, iy), return_counts=True)[1]
+        if level >= MORTON_BITS or (occupancy * occupancy).sum() / n <= 2 * leaf_size:
+            break
+        level += 1
+    return level
+
+def fmm_forces(x, y, mass, G, softening, order=FMM_ORDER, leaf_size=FMM_LEAF_SIZE):
+    n = len(x)
+    fx = np.zeros(n)
+    fy = np.zeros(n)
+    if n < 2:
+        return fx, fy
+    k, l, children, m2l = operators(order)
+    P = len(k)
+    min_x, min_y, size = root_box(x, y)
+    depth = leaf_level(x, y, min_x, min_y, size, leaf_size)
+    side = 1 << depth
+    h = size / side
+    ix = np.clip(((x - min_x) / h).astype(np.int64), 0, side - 1)
+    iy = np.clip(((y - min_y) / h).astype(np.int64), 0, side - 1)
+    key = _key(ix, iy)
+    order_ = np.argsort(key, kind="stable")
+    sx, sy, smass = x[order_], y[order_], mass[order_]
+    # Offset of each particle from its leaf centre, in leaf cell sizes
+    tau = ((sx - min_x) / h - ix[order_] - 0.5) + 1j * ((sy - min_y) / h - iy[order_] - 0.5)
+    leaf_keys, cell_start, cell_count = np.unique(key[order_], return_index=True, return_counts=True)
+    leaf_of = np.repeat(np.arange(len(leaf_keys)), cell_count)
+
+    # P2M
+    moments = np.zeros((len(leaf_keys), P), dtype=complex)
+    exponents = np.arange(order + 1)
+    for lo in range(0, n, BH_BATCH_SIZE):
+        hi = min(lo + BH_BATCH_SIZE, n)
+        powers = tau[lo:hi, None] ** exponents
+        values = smass[lo:hi, None] * powers[:, k] * np.conj(powers[:, l])
+        cells, first = np.unique(leaf_of[lo:hi], return_index=True)
+        moments[cells] += np.add.reduceat(values, first)
+    keys = {depth: leaf_keys}
+    levels = {depth: moments}
+    parent_of = {}  # level -> index of each cell's parent on the level above
+
+    # M2M
+    for level in range(depth - 1, 1, -1):
+        child_keys = keys[level + 1]
+        keys[level], parent_of[level + 1] = np.unique(child_keys >> 2, return_inverse=True)
+        parent = np.zeros((len(keys[level]), P), dtype=complex)
+        for (cx, cy), (up, _) in children.items():
+            sel = (child_keys & 3) == (cx | (cy << 1))
+            parent[parent_of[level + 1][sel]] += levels[level + 1][sel] @ up.T
+        levels[level] = parent
+
+    # M2L and L2L
+    local = None
+    for level in range(2, depth + 1):
+        s = 1 << level
+        cell_keys = keys[level]
+        if local is None:
+            local = np.zeros((len(cell_keys), P), dtype=complex)
+        else:
+            parent = local
+            local = np.empty((len(cell_keys), P), dtype=complex)
+            for (cx, cy), (_, down) in children.items():
+                sel = (cell_keys & 3) == (cx | (cy << 1))
+                local[sel] = parent[parent_of[level][sel]] @ down.T
+        tx = _compact_bits(cell_keys)
+        ty = _compact_bits(cell_keys >> 1)
+        px = tx & 1
+        py = ty & 1
+        for (ox, oy), op in m2l.items():
+            # Children of the parent's neighbours only: which offsets those
+            # are depends on the target's position within its parent
+            target = np.flatnonzero((px + ox >= -2) & (px + ox <= 3) & (py + oy >= -2) & (py + oy <= 3) &
+                                    (tx + ox >= 0) & (tx + ox < s) & (ty + oy >= 0) & (ty + oy < s))
+            source_keys = _key(tx[target] + ox, ty[target] + oy)
+            slot = np.minimum(np.searchsorted(cell_keys, source_keys), len(cell_keys) - 1)
+            found = cell_keys[slot] == source_keys
+            local[target[found]] += levels[level][slot[found]] @ op.T
+
+    # L2P: field = 2 d psi / d conj(t), scaled back from cell units
+    has_m = l > 0
+    field_n = k[has_m]
+    field_m = l[has_m]
+    sx_out = np.empty(n)
+    sy_out = np.empty(n)
+    for lo in range(0, n, BH_BATCH_SIZE):
+        hi = min(lo + BH_BATCH_SIZE, n)
+        powers = tau[lo:hi, None] ** exponents
+        basis = field_m * powers[:, field_n] * np.conj(powers[:, field_m - 1])
+        field = 2 / (h * h) * (local[leaf_of[lo:hi]][:, has_m] * basis).sum(axis=1)
+        sx_out[lo:hi] = G * smass[lo:hi] * field.real
+        sy_out[lo:hi] = G * smass[lo:hi] * field.imag
+
+    # P2P over the 3x3 block of leaf cells around each particle
+    leaf_x = _compact_bits(leaf_keys)[leaf_of]
+    leaf_y = _compact_bits(leaf_keys >> 1)[leaf_of]
+    for lo in range(0, n, BH_BATCH_SIZE):
+        hi = min(lo + BH_BATCH_SIZE, n)
+        part = np.arange(lo, hi)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nx = leaf_x[lo:hi] + dx
+                ny = leaf_y[lo:hi] + dy
+                inside = (nx >= 0) & (nx < side) & (ny >= 0) & (ny < side)
+                neighbour_keys = _key(nx[inside], ny[inside])
+                slot = np.minimum(np.searchsorted(leaf_keys, neighbour_keys), len(leaf_keys) - 1)
+                found = leaf_keys[slot] == neighbour_keys
+                target = part[inside][found]
+                slot = slot[found]
+                counts = cell_count[slot]
+                pair = np.repeat(target, counts)
+                other = np.repeat(cell_start[slot], counts) + _ramp(counts)
+                ddx = sx[other] - sx[pair]
+                ddy = sy[other] - sy[pair]
+                dd_sq = ddx*ddx + ddy*ddy + softening
+                # The particle itself has ddx = ddy = 0 and contributes nothing
+                scale = G * smass[other] * smass[pair] / (dd_sq * np.sqrt(dd_sq))
+                sx_out[lo:hi] += np.bincount(pair - lo, scale * ddx, hi - lo)
+                sy_out[lo:hi] += np.bincount(pair - lo, scale * ddy, hi - lo)
+
+    fx[order_] = sx_out
+    fy[order_] = sy_out
+    return fx, fy
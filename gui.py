@@ -1,5 +1,5 @@
 import pygame
-from constants import WIDTH, HEIGHT, WHITE, BLACK, GRAY, GREEN, RED, BLUE
+from constants import WIDTH, HEIGHT, WHITE, BLACK, GRAY, GREEN, RED, BLUE, FORCE_METHOD, DOMAIN_MODE
 
 class Button:
     def __init__(self, x, y, w, h, text, color=WHITE, text_color=BLACK):
@@ -60,6 +60,9 @@ class GUI:
         self.buttons = []
         self.sliders = []
         self.collision_mode = 0  # 0: Elastic, 1: Merge, 2: Inelastic
+        self.physics_rate = 0.0  # Physics steps per second, shown as a readout
+        self.profile_lines = []  # Profiler HUD, empty when profiling is off
+        self.font = pygame.font.SysFont(None, 24)
         self.setup_gui()
 
     def setup_gui(self):
@@ -75,6 +78,13 @@ class GUI:
         self.buttons.append(Button(100, 90, 80, 30, "Merge"))
         self.buttons.append(Button(190, 90, 80, 30, "Inelastic"))
         self.buttons.append(Button(370, 10, 100, 30, "Full Screen"))
+        self.buttons.append(Button(480, 10, 80, 30, "Stats"))
+        self.buttons.append(Button(280, 90, 80, 30, "Plummer"))
+        self.buttons.append(Button(370, 90, 80, 30, "Disk"))
+        self.buttons.append(Button(460, 90, 80, 30, "Galaxies"))
+        self.buttons.append(Button(570, 10, 170, 30, f"Solver: {FORCE_METHOD}"))
+        self.buttons.append(Button(550, 90, 90, 30, "LOD: off"))
+        self.buttons.append(Button(650, 90, 150, 30, f"Domain: {DOMAIN_MODE}"))
 
         # Sliders
         self.sliders.append(Slider(10, 130, 200, 20, 0.1, 2.0, 1.0, "Zoom"))
@@ -84,6 +94,11 @@ class GUI:
             button.draw(screen)
         for slider in self.sliders:
             slider.draw(screen)
+        rate_surf = self.font.render(f"Physics: {self.physics_rate:.0f} steps/s", True, WHITE)
+        screen.blit(rate_surf, (10, 160))
+        for k, line in enumerate(self.profile_lines):
+            line_surf = self.font.render(line, True, WHITE)
+            screen.blit(line_surf, (10, 185 + 20 * k))
 
     def handle_event(self, event):
         for slider in self.sliders:
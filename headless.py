@@ -0,0 +1,226 @@
+import argparse
+import random
+import time
+
+import numpy as np
+
+from constants import (DOMAIN_ESCAPE, DOMAIN_MODE, DOMAIN_SIZE, DT, ELASTIC, FORCE_METHOD, G,
+                       INELASTIC, MERGE, RECORD_EVERY, SOFTENING, THETA)
+from domain import DOMAIN_MODES, ESCAPE_MODES, Domain
+from linear_quadtree import IncrementalQuadtree
+from parallel import ForcePool
+from physics import FORCE_METHODS, INTEGRATORS, step, total_energy
+import profiler
+from scenarios import SCENARIOS, generate
+from scheduler import SCHEDULE_ORDERS, ForceScheduler
+from snapshot import Trajectory, TrajectoryWriter, load_checkpoint, save_checkpoint, state_hash
+
+# Runs the physics without a window; must never import pygame
+
+COLLISION_MODES = {"elastic": ELASTIC, "merge": MERGE, "inelastic": INELASTIC}
+
+def run(count, seed, collision_mode, integrator, steps, dt=DT, theta=THETA, workers=0,
+        profile=None, time_limit=None, schedule=None, load=None, save=None, record=None,
+        record_every=RECORD_EVERY, scenario="uniform", method=FORCE_METHOD, domain=DOMAIN_MODE,
+        escape=DOMAIN_ESCAPE, domain_size=DOMAIN_SIZE, deterministic=False, hashes=None,
+        reference=None, softening=SOFTENING, energy=False):
+    # profile: optional path; per-step stage times and counters are written
+    # there as JSON (*.json) or CSV
+    # schedule: ForceScheduler order; forces then get time_limit per step
+    # load/save: checkpoint paths to start from (instead of count particles)
+    # and to write at the end; record: trajectory file to append steps to
+    # scenario: initial conditions from scenarios.SCENARIOS
+    # domain/escape/domain_size: see domain.Domain
+    # deterministic: reproducible run; needs a seed (or a checkpoint) and no
+    # wall-clock budget. The quadtree is rebuilt every step instead of
+    # refitted, since a refitted tree keeps the topology and root box of
+    # earlier steps and would make forces depend on how the run got here.
+    # Reductions already run in a fixed order: per-particle sums never
+    # depend on batching or worker count, and collision pairs are sorted.
+    # Each step's state_hash is then written to hashes (one "step hash"
+    # line each) and compared with the same step in the reference
+    # trajectory, e.g. one recorded from another backend.
+    # energy: also report the relative change of total_energy over the run
+    # (estimated from ENERGY_SAMPLE rows for large n)
+    if deterministic:
+        if seed is None and not load:
+            raise ValueError("a deterministic run needs a seed or a checkpoint")
+        if time_limit:
+            raise ValueError("a deterministic run has no wall-clock time limit")
+    if domain == "periodic" and method == "fmm":
+        # Checked up front rather than on the first force pass
+        raise ValueError("fmm does not support periodic domains")
+    random.seed(seed)
+    first_step = 0
+    if load:
+        particles, first_step, mode = load_checkpoint(load)
+        collision_mode = next(name for name, value in COLLISION_MODES.items() if value == mode)
+    else:
+        particles = generate(scenario, count)
+    recorder = TrajectoryWriter(record) if record else None
+    pool = ForcePool(workers) if workers else None
+    tree_cache = IncrementalQuadtree(refit=not deterministic)
+    if integrator == "block":
+        stepper = INTEGRATORS[integrator](softening=softening)
+    else:
+        stepper = INTEGRATORS[integrator]()
+    scheduler = ForceScheduler(schedule, theta, softening=softening) if schedule else None
+    region = Domain(domain, domain_size, escape=escape)
+    hash_log = open(hashes, "w") if deterministic and hashes else None
+    frames_by_step = {}
+    if deterministic and reference:
+        trajectory = Trajectory(reference)
+        frames_by_step = {trajectory[k].step: trajectory[k] for k in range(len(trajectory))}
+    compared = identical = 0
+    first_divergence = None
+    max_deviation = max_force_deviation = 0.0
+    digest = None
+    initial_count = len(particles)
+    initial_energy = total_energy(particles, G, softening, region.period) if energy else None
+    frames = profiler.FrameProfiler(record=True) if profile else profiler.NullProfiler()
+    profiler.activate(frames)
+    start = time.perf_counter()
+    for k in range(first_step + 1, first_step + steps + 1):
+        step(particles, dt, COLLISION_MODES[collision_mode], theta=theta, pool=pool,
+             tree_cache=tree_cache, integrator=stepper, time_limit=time_limit,
+             scheduler=scheduler, method=method, domain=region, softening=softening)
+        frames.end_frame()
+        if recorder is not None and k % record_every == 0:
+            recorder.write(particles, k, COLLISION_MODES[collision_mode])
+        if deterministic:
+            digest = state_hash(particles, k, COLLISION_MODES[collision_mode])
+            if hash_log is not None:
+                hash_log.write(f"{k} {digest}\n")
+            frame = frames_by_step.get(k)
+            if frame is not None:
+                compared += 1
+                if frame.state_hash() == digest:
+                    identical += 1
+                    continue
+                if first_divergence is None:
+                    first_divergence = k
+                if frame.count != len(particles):
+                    max_deviation = max_force_deviation = float("inf")
+                else:
+                    max_deviation = max(max_deviation, float(np.abs(frame.x - particles.x).max()),
+                                        float(np.abs(frame.y - particles.y).max()))
+                    max_force_deviation = max(max_force_deviation,
+                                              float(np.abs(frame.fx - particles.fx).max()),
+                                              float(np.abs(frame.fy - particles.fy).max()))
+    elapsed = time.perf_counter() - start
+    if hash_log is not None:
+        hash_log.close()
+    energy_drift = None
+    if energy:
+        final_energy = total_energy(particles, G, softening, region.period)
+        energy_drift = (final_energy - initial_energy) / abs(initial_energy) if initial_energy else 0.0
+    if recorder is not None:
+        recorder.close()
+    if save:
+        save_checkpoint(save, particles, first_step + steps, COLLISION_MODES[collision_mode])
+    profiler.activate(profiler.NullProfiler())
+    if pool is not None:
+        pool.close()
+    if profile:
+        frames.dump(profile)
+    return {
+        "steps": steps,
+        "elapsed": elapsed,
+        "steps_per_sec": steps / elapsed if elapsed > 0 else float("inf"),
+        "particles": len(particles),
+        "tree_rebuilds": tree_cache.rebuilds,
+        "tree_depth": tree_cache.tree.depth() if tree_cache.tree is not None else 0,
+        "escaped": region.escaped,
+        "merges": initial_count - len(particles) - region.escaped,
+        "energy_drift": energy_drift,
+        "force_evaluations": stepper.force_evaluations,
+        # Only the block integrator tracks the cost of the uniform alternative
+        "saved_evaluations_per_sec": getattr(stepper, "saved_evaluations_per_second", lambda: 0.0)(),
+        "profile": frames.summary_lines() if profile else [],
+        "schedule": scheduler.report(particles) if scheduler else None,
+        "state_hash": digest,
+        # Steps checked against the reference, how many matched bit for bit,
+        # and the largest position and force differences on the others
+        "reference_steps": compared,
+        "identical_steps": identical,
+        "first_divergence": first_divergence,
+        "max_deviation": max_deviation,
+        "max_force_deviation": max_force_deviation,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the simulation without rendering")
+    parser.add_argument("--count", type=int, default=1000, help="number of particles")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="uniform")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--collision-mode", choices=sorted(COLLISION_MODES), default="elastic")
+    parser.add_argument("--integrator", choices=sorted(INTEGRATORS), default="euler")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--dt", type=float, default=DT)
+    parser.add_argument("--theta", type=float, default=THETA)
+    parser.add_argument("--softening", type=float, default=SOFTENING)
+    parser.add_argument("--method", choices=FORCE_METHODS, default=FORCE_METHOD)
+    parser.add_argument("--workers", type=int, default=0, help="force worker processes (0 = in-process)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="write per-step stage timings and counters (.json or .csv)")
+    parser.add_argument("--time-limit", type=float, help="seconds per step for forces")
+    parser.add_argument("--schedule", choices=SCHEDULE_ORDERS,
+                        help="refresh forces fairly within --time-limit, adapting theta")
+    parser.add_argument("--load", metavar="PATH", help="start from a checkpoint instead of --count")
+    parser.add_argument("--save", metavar="PATH", help="write a checkpoint after the last step")
+    parser.add_argument("--record", metavar="PATH", help="append steps to a trajectory file")
+    parser.add_argument("--record-every", type=int, default=RECORD_EVERY)
+    parser.add_argument("--domain", choices=DOMAIN_MODES, default=DOMAIN_MODE)
+    parser.add_argument("--escape", choices=ESCAPE_MODES, default=DOMAIN_ESCAPE,
+                        help="open domain: what to do with particles leaving the box")
+    parser.add_argument("--domain-size", type=float, default=DOMAIN_SIZE)
+    parser.add_argument("--deterministic", action="store_true",
+                        help="reproducible run with a per-step state hash")
+    parser.add_argument("--hashes", metavar="PATH", help="deterministic: write each step's state hash")
+    parser.add_argument("--reference", metavar="PATH",
+                        help="deterministic: compare steps with this trajectory (from --record)")
+    parser.add_argument("--energy", action="store_true",
+                        help="report the relative energy drift (sampled for large counts)")
+    args = parser.parse_args()
+    if args.deterministic and args.time_limit:
+        parser.error("--deterministic runs have no --time-limit")
+    if (args.hashes or args.reference) and not args.deterministic:
+        parser.error("--hashes and --reference need --deterministic")
+    if args.domain == "periodic" and args.method == "fmm":
+        parser.error("--method fmm does not support --domain periodic")
+    stats = run(args.count, args.seed, args.collision_mode, args.integrator, args.steps,
+                dt=args.dt, theta=args.theta, workers=args.workers, profile=args.profile,
+                time_limit=args.time_limit, schedule=args.schedule, load=args.load,
+                save=args.save, record=args.record, record_every=args.record_every,
+                scenario=args.scenario, method=args.method, domain=args.domain,
+                escape=args.escape, domain_size=args.domain_size,
+                deterministic=args.deterministic, hashes=args.hashes, reference=args.reference,
+                softening=args.softening, energy=args.energy)
+    print(f"{stats['steps']} steps in {stats['elapsed']:.3f}s "
+          f"({stats['steps_per_sec']:.1f} steps/sec), {stats['particles']} particles left, "
+          f"{stats['tree_rebuilds']} tree rebuilds, tree depth {stats['tree_depth']}, "
+          f"{stats['escaped']} escaped")
+    print(f"{stats['force_evaluations']} force evaluations, "
+          f"{stats['saved_evaluations_per_sec']:.0f} saved per simulated second")
+    if stats["schedule"]:
+        report = stats["schedule"]
+        print(f"theta {report['theta']:.2f}, {report['fresh_fraction']:.0%} refreshed last step, "
+              f"force error {report['force_error']:.2e}, mean age {report['mean_age']:.2f}, "
+              f"max age {report['max_age']}, {report['never_evaluated']} never evaluated")
+    if stats["energy_drift"] is not None:
+        print(f"energy drift {stats['energy_drift']:.3e}, {stats['merges']} merges")
+    if stats["state_hash"]:
+        print(f"state hash {stats['state_hash']}")
+    if stats["reference_steps"]:
+        print(f"{stats['identical_steps']} of {stats['reference_steps']} steps identical to the "
+              f"reference", end="")
+        if stats["first_divergence"] is not None:
+            print(f", first divergence at step {stats['first_divergence']}, "
+                  f"max deviation {stats['max_deviation']:.3e}, "
+                  f"max force deviation {stats['max_force_deviation']:.3e}", end="")
+        print()
+    for line in stats["profile"]:
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,24 @@
 
+import argparse
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pygame
 
-from constants import (BLACK, BLUE, DT, ELASTIC, FPS, GREEN, HEIGHT, INELASTIC,
-                       MERGE, RED, WHITE, WIDTH)
-from gui import GUI
-from particle import Particle
-from physics import (calculate_forces, generate_particles, handle_collisions,
-                     update_particles)
+from constants import (BLACK, BLUE, CHECKPOINT_PATH, DT, ELASTIC, FORCE_WORKERS, FPS, GRAY,
+                       GREEN, HEIGHT, INELASTIC, MERGE, RED, WHITE, WIDTH)
+from domain import DOMAIN_MODES, Domain
+from gui import GUI, Slider
+from parallel import ForcePool
+from particle import ParticleSystem
+from profiler import FrameProfiler, NullProfiler
+from renderer import draw_lod, draw_particles
+from physics import FORCE_METHODS
+from scenarios import generate
+from snapshot import Trajectory, TrajectoryWriter, load_checkpoint, save_checkpoint
+from worker import PhysicsWorker
 
 
 class Camera:
@@ -30,22 +39,128 @@ class Camera:
         wy = (sy - self.screen_height / 2) / self.zoom + self.y
         return wx, wy
 
+    def world_to_screen_array(self, wx, wy):
+        sx = (np.asarray(wx) - self.x) * self.zoom + self.screen_width / 2
+        sy = (np.asarray(wy) - self.y) * self.zoom + self.screen_height / 2
+        return sx, sy
+
+    def screen_to_world_array(self, sx, sy):
+        wx = (np.asarray(sx) - self.screen_width / 2) / self.zoom + self.x
+        wy = (np.asarray(sy) - self.screen_height / 2) / self.zoom + self.y
+        return wx, wy
+
+def delete_at(particles, wx, wy):
+    hit = np.flatnonzero((particles.x - wx)**2 + (particles.y - wy)**2 < particles.radius**2)
+    if len(hit):
+        particles.remove(hit[0])
+
+def replay(path):
+    # Trajectory viewer: space plays/pauses, left/right step one frame, the
+    # slider scrubs. Frames are memory-mapped, so only the one on screen is
+    # read from disk; frames appended by a running recorder show up live.
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
+    pygame.display.set_caption(f"Replay: {path}")
+    clock = pygame.time.Clock()
+    font = pygame.font.SysFont(None, 24)
+    trajectory = Trajectory(path)
+    camera = Camera(WIDTH / 2, HEIGHT / 2)
+    scrubber = Slider(10, HEIGHT - 40, WIDTH - 20, 20, 0, max(len(trajectory) - 1, 1), 0, "Frame")
+    playing = False
+    dragging = False
+    last_mouse_pos = (0, 0)
+
+    running = True
+    while running:
+        clock.tick(FPS)
+        trajectory.refresh()
+        last = max(len(trajectory) - 1, 0)
+        scrubber.max_val = max(last, 1)
+        index = min(int(scrubber.val), last)
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.VIDEORESIZE:
+                screen = pygame.display.set_mode((event.w, event.h), pygame.RESIZABLE)
+                camera.screen_width, camera.screen_height = event.w, event.h
+                scrubber.rect = pygame.Rect(10, event.h - 40, event.w - 20, 20)
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    playing = not playing
+                elif event.key == pygame.K_RIGHT:
+                    index = min(index + 1, last)
+                elif event.key == pygame.K_LEFT:
+                    index = max(index - 1, 0)
+                scrubber.val = index
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                if event.button == 3:
+                    dragging = True
+                    last_mouse_pos = event.pos
+                elif event.button == 4:
+                    camera.zoom *= 1.1
+                elif event.button == 5:
+                    camera.zoom /= 1.1
+            elif event.type == pygame.MOUSEBUTTONUP:
+                dragging = False
+            elif event.type == pygame.MOUSEMOTION and dragging:
+                camera.x -= (event.pos[0] - last_mouse_pos[0]) / camera.zoom
+                camera.y -= (event.pos[1] - last_mouse_pos[1]) / camera.zoom
+                last_mouse_pos = event.pos
+            scrubber.handle_event(event)
+        if playing and not scrubber.dragging:
+            scrubber.val = min(int(scrubber.val) + 1, last)
+
+        screen.fill(BLACK)
+        if len(trajectory):
+            frame = trajectory[min(int(scrubber.val), last)]
+            draw_particles(screen, camera, frame.x, frame.y, frame.radius, frame.color)
+            label = f"Step {frame.step}, {frame.count} particles"
+            screen.blit(font.render(label, True, WHITE), (10, 10))
+        scrubber.draw(screen)
+        pygame.display.flip()
+    pygame.quit()
+
 def main():
+    parser = argparse.ArgumentParser(description="2D N-body particle simulation")
+    parser.add_argument("--load", metavar="PATH", help="start from a saved checkpoint")
+    parser.add_argument("--record", metavar="PATH", help="append every step to a trajectory file")
+    parser.add_argument("--replay", metavar="PATH", help="view a recorded trajectory instead")
+    args = parser.parse_args()
+    if args.replay:
+        replay(args.replay)
+        sys.exit()
+
     pygame.init()
     screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
     pygame.display.set_caption("2D N-Body Particle Simulation")
     clock = pygame.time.Clock()
 
-    MAX_PHYSICS_TIME = 0.016  # Don't block longer than 16ms
-
     screen_width, screen_height = WIDTH, HEIGHT
     full_screen = False
 
-    particles = []
+    particles = ParticleSystem()
     camera = Camera(screen_width=screen_width, screen_height=screen_height)
     camera.x = WIDTH / 2
     camera.y = HEIGHT / 2
     gui = GUI()
+    pool = ForcePool(FORCE_WORKERS) if FORCE_WORKERS else None
+    # Physics runs on its own thread; the particles are only touched through it
+    physics = PhysicsWorker(particles, DT, gui.collision_mode, pool)
+    if args.load:
+        loaded, step_count, gui.collision_mode = load_checkpoint(args.load)
+        physics.restore(loaded, step_count)
+    recorder = TrajectoryWriter(args.record) if args.record else None
+    physics.recorder = recorder
+    physics.start()
+    spawner = ThreadPoolExecutor(1)
+
+    def spawn(scenario, count):
+        # Generate on a helper thread, then hand the batch to the physics thread
+        def job():
+            batch = generate(scenario, count)
+            physics.submit(lambda p: p.extend(batch))
+        spawner.submit(job)
+    render_stats = NullProfiler()
 
     # Modes
     spawning = False
@@ -66,6 +181,16 @@ def main():
                 camera.screen_width = screen_width
                 camera.screen_height = screen_height
                 # Adjust GUI if needed, but for simplicity, keep fixed
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F5:  # Save checkpoint
+                    physics.submit(lambda p: save_checkpoint(CHECKPOINT_PATH, p, physics.steps,
+                                                             physics.collision_mode))
+                elif event.key == pygame.K_F9:  # Restore checkpoint
+                    try:
+                        loaded, step_count, gui.collision_mode = load_checkpoint(CHECKPOINT_PATH)
+                        physics.restore(loaded, step_count)
+                    except (OSError, ValueError) as e:
+                        print(f"Could not load {CHECKPOINT_PATH}: {e}")
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:  # Left click
                     pos = pygame.mouse.get_pos()
@@ -75,15 +200,15 @@ def main():
                     elif button_idx == 1:  # Delete
                         deleting = True
                     elif button_idx == 2:  # Clear
-                        particles.clear()
+                        physics.submit(lambda p: p.clear())
                     elif button_idx == 3:  # 100
-                        particles.extend(generate_particles(100))
+                        spawn("uniform", 100)
                     elif button_idx == 4:  # 500
-                        particles.extend(generate_particles(500))
+                        spawn("uniform", 500)
                     elif button_idx == 5:  # 1000
-                        particles.extend(generate_particles(1000))
+                        spawn("uniform", 1000)
                     elif button_idx == 6:  # 10000
-                        particles.extend(generate_particles(10000))
+                        spawn("uniform", 10000)
                     elif button_idx == 7:  # Elastic
                         gui.collision_mode = ELASTIC
                     elif button_idx == 8:  # Merge
@@ -99,17 +224,44 @@ def main():
                         screen_width, screen_height = screen.get_size()
                         camera.screen_width = screen_width
                         camera.screen_height = screen_height
+                    elif button_idx == 11:  # Stats
+                        if render_stats.enabled:
+                            physics.stats = NullProfiler()
+                            render_stats = NullProfiler()
+                        else:
+                            physics.stats = FrameProfiler()
+                            render_stats = FrameProfiler()
+                    elif button_idx == 12:  # Plummer
+                        spawn("plummer", 10000)
+                    elif button_idx == 13:  # Disk
+                        spawn("disk", 10000)
+                    elif button_idx == 14:  # Galaxies
+                        spawn("galaxies", 10000)
+                    elif button_idx == 15:  # Cycle force solver
+                        physics.method = FORCE_METHODS[(FORCE_METHODS.index(physics.method) + 1) %
+                                                       len(FORCE_METHODS)]
+                        if physics.method == "fmm" and physics.domain.period is not None:
+                            physics.method = FORCE_METHODS[FORCE_METHODS.index("fmm") + 1]
+                        gui.buttons[15].text = f"Solver: {physics.method}"
+                    elif button_idx == 16:  # Level-of-detail rendering
+                        physics.lod = not physics.lod
+                        gui.buttons[16].text = "LOD: on" if physics.lod else "LOD: off"
+                    elif button_idx == 17:  # Cycle simulation domain
+                        mode = DOMAIN_MODES[(DOMAIN_MODES.index(physics.domain.mode) + 1) %
+                                            len(DOMAIN_MODES)]
+                        if mode == "periodic" and physics.method == "fmm":
+                            physics.method = "barnes_hut"
+                            gui.buttons[15].text = f"Solver: {physics.method}"
+                        physics.domain = Domain(mode)
+                        gui.buttons[17].text = f"Domain: {mode}"
                     else:
                         if spawning:
                             wx, wy = camera.screen_to_world(*pos)
-                            particles.append(Particle(wx, wy))
+                            physics.submit(lambda p, wx=wx, wy=wy: p.add(wx, wy))
                             spawning = False
                         elif deleting:
                             wx, wy = camera.screen_to_world(*pos)
-                            for p in particles[:]:
-                                if (p.x - wx)**2 + (p.y - wy)**2 < p.radius**2:
-                                    particles.remove(p)
-                                    break
+                            physics.submit(lambda p, wx=wx, wy=wy: delete_at(p, wx, wy))
                             deleting = False
                         else:
                             dragging = True
@@ -135,26 +287,52 @@ def main():
         # Update camera zoom from slider
         camera.zoom = gui.get_zoom()
 
-        # Physics with time budget to prevent freezing
-        calculate_forces(particles, use_barnes_hut=True, time_limit=MAX_PHYSICS_TIME)
-        update_particles(particles, DT)
-        handle_collisions(particles, gui.collision_mode, time_limit=MAX_PHYSICS_TIME)
+        physics.collision_mode = gui.collision_mode
+        gui.physics_rate = physics.steps_per_sec
+        if render_stats.enabled:
+            gui.profile_lines = physics.stats.summary_lines() + render_stats.summary_lines()
+        else:
+            gui.profile_lines = []
 
         # Render
         screen.fill(BLACK)
 
-        # Draw particles
-        for p in particles:
-            sx, sy = camera.world_to_screen(p.x, p.y)
-            radius = p.radius * camera.zoom
-            if radius > 0.5 and 0 <= sx < screen_width and 0 <= sy < screen_height:  # Only draw if on screen
-                pygame.draw.circle(screen, p.color, (int(sx), int(sy)), int(radius))
+        # Outline of a bounded domain
+        if physics.domain.tree_box() is not None:
+            min_x, min_y, size = physics.domain.box
+            sx, sy = camera.world_to_screen(min_x, min_y)
+            pygame.draw.rect(screen, GRAY, (sx, sy, size * camera.zoom, size * camera.zoom), 1)
+
+        # Draw particles from the latest published physics step
+        snapshot = physics.acquire()
+        n = snapshot.count
+        with render_stats.stage("draw"):
+            if snapshot.nodes is not None:
+                draw_lod(screen, camera, snapshot.x[:n], snapshot.y[:n], snapshot.radius[:n],
+                         snapshot.color[:n], snapshot.nodes)
+            else:
+                draw_particles(screen, camera, snapshot.x[:n], snapshot.y[:n],
+                               snapshot.radius[:n], snapshot.color[:n])
+        # Published by the physics thread with this step's particles
+        report = snapshot.schedule
+        if render_stats.enabled and report is not None:
+            gui.profile_lines.append(
+                f"theta {report['theta']:.2f}, fresh {report['fresh_fraction']:.0%}, "
+                f"error {report['force_error']:.1e}, max age {report['max_age']}")
+        physics.release()
+        render_stats.end_frame()
 
         # Draw GUI
         gui.draw(screen)
 
         pygame.display.flip()
 
+    spawner.shutdown(cancel_futures=True)
+    physics.stop()
+    if recorder is not None:
+        recorder.close()
+    if pool is not None:
+        pool.close()
     pygame.quit()
     sys.exit()
 
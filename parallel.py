@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from constants import BH_BATCH_SIZE, CHUNKS_PER_WORKER
+from linear_quadtree import QUADRUPOLE_FIELDS, TRAVERSAL_FIELDS, LinearQuadtree
+
+# Per-worker cache of attached blocks: field -> SharedMemory
+_attached = {}
+
+def _attach(layout):
+    arrays = {}
+    for field, (name, dtype, length) in layout.items():
+        shm = _attached.get(field)
+        if shm is None or shm.name != name:
+            if shm is not None:
+                shm.close()
+            shm = shared_memory.SharedMemory(name=name)
+            _attached[field] = shm
+        arrays[field] = np.ndarray(length, dtype=dtype, buffer=shm.buf)
+    return arrays
+
+def _worker_forces(layout, lo, hi, theta, G, softening, deadline, period):
+    arrays = _attach(layout)
+    tree = LinearQuadtree.from_arrays(arrays, period)
+    fx = arrays["fx"]
+    fy = arrays["fy"]
+    for start in range(lo, hi, BH_BATCH_SIZE):
+        if deadline and time.time() > deadline:
+            break
+        targets = np.arange(start, min(start + BH_BATCH_SIZE, hi))
+        fx[targets], fy[targets] = tree.batched_forces(theta, G, softening, targets)
+
+class ForcePool:
+    # Persistent process pool for Barnes-Hut forces. The tree and particle
+    # arrays are copied once per step into shared memory blocks that workers
+    # map by name, and each task is a contiguous range of the Morton-sorted
+    # particles, so only block names and range bounds are pickled.
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(workers)
+        self.blocks = {}
+
+    def _publish(self, field, values):
+        shm = self.blocks.get(field)
+        if shm is None or shm.size < values.nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            # Grow geometrically so block names change rarely
+            size = max(values.nbytes * 2, 4096)
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self.blocks[field] = shm
+        target = np.ndarray(len(values), dtype=values.dtype, buffer=shm.buf)
+        target[:] = values
+        return shm.name, values.dtype.str, len(values)
+
+    def calculate_forces(self, tree, theta, G, softening, fx, fy, time_limit=None):
+        # fx/fy are in sorted order and hold the previous forces on entry, so
+        # ranges cut off by time_limit keep them, as in the serial path
+        layout = {}
+        for field in TRAVERSAL_FIELDS + (QUADRUPOLE_FIELDS if tree.quadrupole else ()):
+            layout[field] = self._publish(field, getattr(tree, field))
+        layout["fx"] = self._publish("fx", fx)
+        layout["fy"] = self._publish("fy", fy)
+        deadline = time.time() + time_limit if time_limit else None
+
+        n = len(tree.x)
+        bounds = np.linspace(0, n, self.workers * CHUNKS_PER_WORKER + 1).astype(int)
+        futures = [self.executor.submit(_worker_forces, layout, lo, hi, theta, G, softening, deadline,
+                                        tree.period)
+                   for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        for future in wait(futures).done:
+            future.result()
+        fx[:] = np.ndarray(n, dtype=fx.dtype, buffer=self.blocks["fx"].buf)
+        fy[:] = np.ndarray(n, dtype=fy.dtype, buffer=self.blocks["fy"].buf)
+
+    def close(self):
+        self.executor.shutdown()
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks.clear()
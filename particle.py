@@ -1,7 +1,15 @@
 import math
-from constants import DEFAULT_MASS, DEFAULT_RADIUS, WHITE
+
+import numpy as np
+
+from constants import DEFAULT_MASS, DEFAULT_RADIUS, ELASTIC, INELASTIC_RESTITUTION, MERGE, WHITE
 
 class Particle:
+    # Slotted: no per-instance __dict__. The collision methods take an
+    # optional squared distance or unit normal (nx, ny) from the caller, so
+    # a pair that was just tested is not measured again.
+    __slots__ = ("x", "y", "vx", "vy", "mass", "radius", "color", "fx", "fy")
+
     def __init__(self, x, y, vx=0, vy=0, mass=DEFAULT_MASS, radius=DEFAULT_RADIUS, color=WHITE):
         self.x = x
         self.y = y
@@ -32,62 +40,281 @@ class Particle:
         self.x += self.vx * dt
         self.y += self.vy * dt
 
-    def distance_to(self, other):
+    def distance_sq_to(self, other):
         dx = self.x - other.x
         dy = self.y - other.y
-        return math.sqrt(dx*dx + dy*dy)
+        return dx*dx + dy*dy
+
+    def distance_to(self, other):
+        return math.sqrt(self.distance_sq_to(other))
 
-    def collides_with(self, other):
-        dist = self.distance_to(other)
-        return dist < self.radius + other.radius
+    def collides_with(self, other, dist_sq=None):
+        if dist_sq is None:
+            dist_sq = self.distance_sq_to(other)
+        reach = self.radius + other.radius
+        return dist_sq < reach * reach
+
+    def collision_normal(self, other, dist_sq=None):
+        # Unit vector from self towards other, None if they coincide
+        if dist_sq is None:
+            dist_sq = self.distance_sq_to(other)
+        if dist_sq == 0:
+            return None
+        inv = 1 / math.sqrt(dist_sq)
+        return (other.x - self.x) * inv, (other.y - self.y) * inv
 
     def merge_with(self, other):
         # Conservation of momentum
         total_mass = self.mass + other.mass
         self.vx = (self.vx * self.mass + other.vx * other.mass) / total_mass
         self.vy = (self.vy * self.mass + other.vy * other.mass) / total_mass
-        self.mass = total_mass
-        self.radius = math.sqrt(self.radius**2 + other.radius**2)  # Approximate volume conservation
-        # Position: center of mass
+        # Position: center of mass, weighted by the masses before merging
         self.x = (self.x * self.mass + other.x * other.mass) / total_mass
         self.y = (self.y * self.mass + other.y * other.mass) / total_mass
+        self.mass = total_mass
+        self.radius = math.sqrt(self.radius**2 + other.radius**2)  # Approximate volume conservation
 
-    def elastic_collide(self, other):
+    def elastic_collide(self, other, normal=None):
         # Simple elastic collision for 2D
-        dx = other.x - self.x
-        dy = other.y - self.y
-        dist = math.sqrt(dx*dx + dy*dy)
-        if dist == 0:
-            return  # Avoid division by zero
-        nx = dx / dist
-        ny = dy / dist
+        self.inelastic_collide(other, 1.0, normal)
+
+    def inelastic_collide(self, other, restitution=0.5, normal=None):
+        # Impulse along the normal; restitution 1 is elastic
+        if normal is None:
+            normal = self.collision_normal(other)
+            if normal is None:
+                return  # Avoid division by zero
+        nx, ny = normal
 
         # Relative velocity
         dvx = other.vx - self.vx
         dvy = other.vy - self.vy
 
-        # Impulse
-        impulse = 2 * (dvx * nx + dvy * ny) / (1/self.mass + 1/other.mass)
+        # Impulse, unless they are already moving apart
+        closing = dvx * nx + dvy * ny
+        if closing >= 0:
+            return
+        impulse = (1 + restitution) * closing / (1/self.mass + 1/other.mass)
         self.vx += impulse * nx / self.mass
         self.vy += impulse * ny / self.mass
         other.vx -= impulse * nx / other.mass
         other.vy -= impulse * ny / other.mass
 
-    def inelastic_collide(self, other, restitution=0.5):
-        # Inelastic with energy loss
-        dx = other.x - self.x
-        dy = other.y - self.y
-        dist = math.sqrt(dx*dx + dy*dy)
-        if dist == 0:
+
+def resolve_pairs(particles, i, j, collision_mode, restitution=INELASTIC_RESTITUTION):
+    # Object-model counterpart of physics.handle_collisions: resolves
+    # candidate pairs (i, j), e.g. from physics.find_collision_pairs, on a
+    # list of Particles in order, each pair measured once and the impulse
+    # applied inline. Merged particles are flagged by index rather than
+    # looked up in a set, and only removed from the list at the end.
+    # Returns the number of pairs resolved.
+    absorbed = [False] * len(particles)
+    resolved = 0
+    bounce = 2.0 if collision_mode == ELASTIC else 1 + restitution
+    for a, b in zip(i.tolist(), j.tolist()):
+        if absorbed[a] or absorbed[b]:
+            continue
+        p = particles[a]
+        q = particles[b]
+        dx = q.x - p.x
+        dy = q.y - p.y
+        dist_sq = dx*dx + dy*dy
+        reach = p.radius + q.radius
+        if dist_sq >= reach * reach:
+            continue
+        resolved += 1
+        if collision_mode == MERGE:
+            p.merge_with(q)
+            absorbed[b] = True
+        elif dist_sq > 0:
+            # Same impulse as inelastic_collide
+            inv = 1 / math.sqrt(dist_sq)
+            nx = dx * inv
+            ny = dy * inv
+            closing = (q.vx - p.vx) * nx + (q.vy - p.vy) * ny
+            if closing >= 0:
+                continue
+            impulse = bounce * closing / (1/p.mass + 1/q.mass)
+            p.vx += impulse * nx / p.mass
+            p.vy += impulse * ny / p.mass
+            q.vx -= impulse * nx / q.mass
+            q.vy -= impulse * ny / q.mass
+    if collision_mode == MERGE:
+        particles[:] = [p for p, gone in zip(particles, absorbed) if not gone]
+    return resolved
+
+
+def _view_field(name):
+    def fget(self):
+        return self.system.buffers[name][self.index]
+
+    def fset(self, value):
+        self.system.buffers[name][self.index] = value
+
+    return property(fget, fset)
+
+
+class ParticleView(Particle):
+    # Per-particle handle into a ParticleSystem. Removal swaps the last particle
+    # into the freed slot, so views must not be held across add/remove calls.
+    __slots__ = ("system", "index")
+
+    def __init__(self, system, index):
+        self.system = system
+        self.index = index
+
+    x = _view_field("x")
+    y = _view_field("y")
+    vx = _view_field("vx")
+    vy = _view_field("vy")
+    fx = _view_field("fx")
+    fy = _view_field("fy")
+    mass = _view_field("mass")
+    radius = _view_field("radius")
+
+    @property
+    def color(self):
+        return tuple(int(c) for c in self.system.buffers["color"][self.index])
+
+    @color.setter
+    def color(self, value):
+        self.system.buffers["color"][self.index] = value
+
+
+def _array_field(name):
+    def fget(self):
+        return self.buffers[name][:self.count]
+
+    def fset(self, value):
+        self.buffers[name][:self.count] = value
+
+    return property(fget, fset)
+
+
+class ParticleSystem:
+    # Structure-of-arrays particle store. Each field lives in a contiguous
+    # buffer of length `capacity`; only the first `count` entries are live.
+    FIELDS = ("x", "y", "vx", "vy", "fx", "fy", "mass", "radius")
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.capacity = capacity
+        self.generation = 0  # Bumped whenever particles are added or removed
+        self.buffers = {name: np.zeros(capacity) for name in self.FIELDS}
+        self.buffers["color"] = np.zeros((capacity, 3), dtype=np.uint8)
+        # Force passes since fx/fy were last computed; -1 until the first
+        self.buffers["force_age"] = np.zeros(capacity, dtype=np.int64)
+
+    x = _array_field("x")
+    y = _array_field("y")
+    vx = _array_field("vx")
+    vy = _array_field("vy")
+    fx = _array_field("fx")
+    fy = _array_field("fy")
+    mass = _array_field("mass")
+    radius = _array_field("radius")
+    color = _array_field("color")
+    force_age = _array_field("force_age")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("particle index out of range")
+        return ParticleView(self, index)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield ParticleView(self, i)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
             return
-        nx = dx / dist
-        ny = dy / dist
+        # Grow geometrically so repeated adds are amortized O(1)
+        new_capacity = max(capacity, self.capacity * 2)
+        for name, buffer in self.buffers.items():
+            grown = np.zeros((new_capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+            grown[:self.count] = buffer[:self.count]
+            self.buffers[name] = grown
+        self.capacity = new_capacity
 
-        dvx = other.vx - self.vx
-        dvy = other.vy - self.vy
+    def add(self, x, y, vx=0, vy=0, mass=DEFAULT_MASS, radius=DEFAULT_RADIUS, color=WHITE):
+        self.reserve(self.count + 1)
+        i = self.count
+        b = self.buffers
+        b["x"][i] = x
+        b["y"][i] = y
+        b["vx"][i] = vx
+        b["vy"][i] = vy
+        b["fx"][i] = 0
+        b["fy"][i] = 0
+        b["mass"][i] = mass
+        b["radius"][i] = radius
+        b["color"][i] = color
+        b["force_age"][i] = -1
+        self.count += 1
+        self.generation += 1
+        return i
 
-        impulse = (1 + restitution) * (dvx * nx + dvy * ny) / (1/self.mass + 1/other.mass)
-        self.vx += impulse * nx / self.mass
-        self.vy += impulse * ny / self.mass
-        other.vx -= impulse * nx / other.mass
-        other.vy -= impulse * ny / other.mass
+    def add_many(self, x, y, vx, vy, mass, radius, color=WHITE):
+        start = self.count
+        end = start + len(x)
+        self.reserve(end)
+        b = self.buffers
+        b["x"][start:end] = x
+        b["y"][start:end] = y
+        b["vx"][start:end] = vx
+        b["vy"][start:end] = vy
+        b["fx"][start:end] = 0
+        b["fy"][start:end] = 0
+        b["mass"][start:end] = mass
+        b["radius"][start:end] = radius
+        b["color"][start:end] = color
+        b["force_age"][start:end] = -1
+        self.count = end
+        self.generation += 1
+        return start
+
+    def extend(self, other):
+        if isinstance(other, ParticleSystem):
+            self.add_many(other.x, other.y, other.vx, other.vy, other.mass, other.radius, other.color)
+        else:
+            for p in other:
+                self.add(p.x, p.y, p.vx, p.vy, p.mass, p.radius, p.color)
+
+    def remove(self, index):
+        last = self.count - 1
+        if index != last:
+            for buffer in self.buffers.values():
+                buffer[index] = buffer[last]
+        self.count = last
+        self.generation += 1
+
+    def remove_many(self, indices):
+        indices = np.unique(indices)
+        if len(indices) == 0:
+            return
+        # Swap-remove compaction: holes below the new count are filled with the
+        # surviving particles from the tail, everything else stays in place.
+        new_count = self.count - len(indices)
+        holes = indices[indices < new_count]
+        survivors = np.setdiff1d(np.arange(new_count, self.count), indices, assume_unique=True)
+        for buffer in self.buffers.values():
+            buffer[holes] = buffer[survivors]
+        self.count = new_count
+        self.generation += 1
+
+    def clear(self):
+        self.count = 0
+        self.generation += 1
+
+    def copy(self):
+        other = ParticleSystem(max(self.count, 1))
+        other.extend(self)
+        other.fx[:] = self.fx
+        other.fy[:] = self.fy
+        other.force_age[:] = self.force_age
+        return other
@@ -1,17 +1,35 @@
-import random
 import time
-from constants import G, SOFTENING, THETA, ELASTIC, MERGE, INELASTIC, WIDTH, HEIGHT
+
+import numpy as np
+
+from constants import (BH_BATCH_SIZE, BRUTE_FORCE_CHUNK, ENERGY_BLOCK, ENERGY_SAMPLE, G,
+                       SOFTENING, THETA, TREE_BACKEND, ELASTIC, MERGE, INELASTIC,
+                       INELASTIC_RESTITUTION, WIDTH, HEIGHT, FORCE_METHOD)
+from fmm import fmm_forces
+from pm import pm_forces
+from integrators import (BlockTimestepIntegrator, EulerIntegrator, LeapfrogIntegrator,
+                         drift, kick)
+from linear_quadtree import LinearQuadtree, _ramp
 from quadtree import Quadtree, Rectangle
-from particle import Particle
+import profiler
+import scenarios
 
-def build_quadtree(particles):
+def build_quadtree(particles, backend=TREE_BACKEND, domain=None):
+    # A bounded domain fixes the linear tree's root box (and period)
+    if backend == "linear":
+        if domain is None:
+            return LinearQuadtree(particles.x, particles.y, particles.mass)
+        return LinearQuadtree(particles.x, particles.y, particles.mass, box=domain.tree_box(),
+                              period=domain.period)
+    if domain is not None and domain.period is not None:
+        raise ValueError("periodic domains need the linear tree backend")
     # Find bounds
-    if not particles:
+    if not len(particles):
         return Quadtree(Rectangle(0, 0, WIDTH, HEIGHT))
-    min_x = min(p.x for p in particles)
-    max_x = max(p.x for p in particles)
-    min_y = min(p.y for p in particles)
-    max_y = max(p.y for p in particles)
+    min_x = particles.x.min()
+    max_x = particles.x.max()
+    min_y = particles.y.min()
+    max_y = particles.y.max()
     center_x = (min_x + max_x) / 2
     center_y = (min_y + max_y) / 2
     size = max(max_x - min_x, max_y - min_y) * 1.1  # Add margin
@@ -21,72 +39,416 @@ def build_quadtree(particles):
         qt.insert(p)
     return qt
 
-def calculate_forces(particles, use_barnes_hut=True, time_limit=None):
+def brute_force_forces(x, y, mass, G, softening, fx, fy, time_limit=None, targets=None,
+                       period=None):
+    # O(n^2) pairwise forces, evaluated in row blocks to bound memory use.
+    # Only the targets rows are computed (all by default); rows not reached
+    # before time_limit keep their previous forces. With a period,
+    # separations are minimum images.
     start = time.time()
-    if use_barnes_hut:
-        qt = build_quadtree(particles)
-        for p in particles:
-            if time_limit and time.time() - start > time_limit:
-                break
-            p.reset_force()
-            fx, fy = qt.calculate_force(p, THETA, G, SOFTENING)
-            p.apply_force(fx, fy)
+    rows = np.arange(len(x)) if targets is None else np.asarray(targets)
+    for lo in range(0, len(rows), BRUTE_FORCE_CHUNK):
+        if time_limit and time.time() - start > time_limit:
+            profiler.active.count("force_truncations")
+            break
+        block = rows[lo:lo + BRUTE_FORCE_CHUNK]
+        dx = x[None, :] - x[block, None]
+        dy = y[None, :] - y[block, None]
+        if period is not None:
+            dx -= period * np.round(dx / period)
+            dy -= period * np.round(dy / period)
+        dist_sq = dx*dx + dy*dy + softening
+        # The self term has dx = dy = 0 and so contributes nothing
+        scale = G * mass[None, :] / (dist_sq * np.sqrt(dist_sq))
+        fx[block] = mass[block] * (scale * dx).sum(axis=1)
+        fy[block] = mass[block] * (scale * dy).sum(axis=1)
+
+FORCE_METHODS = ("barnes_hut", "fmm", "pm", "p3m", "brute_force")
+
+def total_energy(particles, G, softening, period=None, sample=ENERGY_SAMPLE):
+    # Kinetic plus softened potential energy, -G m m' / sqrt(r^2 + softening)
+    # per pair. Potential rows are summed in blocks sized from n, so
+    # temporaries stay near ENERGY_BLOCK terms. Above sample particles only
+    # that many rows are summed (always the same indices, so the start and
+    # end of a run are estimated alike) and scaled up; None sums all n^2.
+    x, y, mass = particles.x, particles.y, particles.mass
+    n = len(x)
+    kinetic = 0.5 * float((mass * (particles.vx**2 + particles.vy**2)).sum())
+    if sample is None or n <= sample:
+        rows = np.arange(n)
     else:
-        # O(n^2) brute force
-        for i, p1 in enumerate(particles):
+        rows = np.sort(np.random.default_rng(0).choice(n, sample, replace=False))
+    potential = 0.0
+    block = max(1, ENERGY_BLOCK // max(n, 1))
+    for lo in range(0, len(rows), block):
+        part = rows[lo:lo + block]
+        dx = x[None, :] - x[part, None]
+        dy = y[None, :] - y[part, None]
+        if period is not None:
+            dx -= period * np.round(dx / period)
+            dy -= period * np.round(dy / period)
+        pair = mass[None, :] / np.sqrt(dx*dx + dy*dy + softening)
+        pair[np.arange(len(part)), part] = 0.0  # No self term
+        potential += float((mass[part] * pair.sum(axis=1)).sum())
+    # Every pair appears in two full rows
+    if len(rows):
+        potential *= -0.5 * G * n / len(rows)
+    return kinetic + potential
+
+def calculate_forces(particles, use_barnes_hut=True, time_limit=None, theta=THETA,
+                     backend=TREE_BACKEND, pool=None, tree=None, targets=None,
+                     method=FORCE_METHOD, domain=None, softening=SOFTENING):
+    # tree: optional prebuilt LinearQuadtree for the current positions
+    # targets: optional particle indices; only their forces are recomputed
+    # method: one of FORCE_METHODS; use_barnes_hut=False also means brute force.
+    # FMM and the particle mesh (PM, or P3M with its short-range correction)
+    # are single passes over all particles and ignore time_limit.
+    # domain: optional Domain; a periodic one gives minimum-image gravity
+    # (a periodic mesh for PM/P3M), which FMM does not support.
+    if method not in FORCE_METHODS:
+        raise ValueError(f"unknown force method {method!r}, expected one of {FORCE_METHODS}")
+    period = domain.period if domain is not None else None
+    if period is not None and method == "fmm":
+        raise ValueError("fmm does not support periodic domains")
+    if method == "brute_force":
+        use_barnes_hut = False
+    start = time.time()
+    if tree is not None:
+        backend = "linear"
+    if use_barnes_hut and method != "barnes_hut":
+        if method == "fmm":
+            fx, fy = fmm_forces(particles.x, particles.y, particles.mass, G, softening)
+        else:
+            fx, fy = pm_forces(particles.x, particles.y, particles.mass, G, softening,
+                               periodic=period is not None, p3m=method == "p3m",
+                               box=domain.box if period is not None else None, tree=tree)
+        index = slice(None) if targets is None else targets
+        particles.fx[index] = fx[index]
+        particles.fy[index] = fy[index]
+    elif use_barnes_hut and backend == "linear" and pool is not None and targets is None:
+        # Multi-core: workers read the tree from shared memory
+        qt = tree if tree is not None else build_quadtree(particles, backend, domain)
+        fx = particles.fx[qt.order]
+        fy = particles.fy[qt.order]
+        remaining = time_limit - (time.time() - start) if time_limit else None
+        pool.calculate_forces(qt, theta, G, softening, fx, fy, remaining)
+        particles.fx[qt.order] = fx
+        particles.fy[qt.order] = fy
+    elif use_barnes_hut and backend == "linear":
+        # Batched traversal in Morton order; each batch is spatially coherent
+        qt = tree if tree is not None else build_quadtree(particles, backend, domain)
+        if targets is None:
+            sorted_targets = np.arange(len(particles))
+        else:
+            rank = np.empty(len(particles), dtype=np.int64)
+            rank[qt.order] = np.arange(len(particles))
+            sorted_targets = np.sort(rank[targets])
+        fx = particles.fx
+        fy = particles.fy
+        for lo in range(0, len(sorted_targets), BH_BATCH_SIZE):
             if time_limit and time.time() - start > time_limit:
+                profiler.active.count("force_truncations")
                 break
-            p1.reset_force()
-            for j, p2 in enumerate(particles):
-                if i == j:
-                    continue
-                if time_limit and time.time() - start > time_limit:
-                    break
-                dx = p2.x - p1.x
-                dy = p2.y - p1.y
-                dist_sq = dx*dx + dy*dy + SOFTENING
-                dist = dist_sq ** 0.5
-                force = G * p1.mass * p2.mass / dist_sq
-                fx = force * dx / dist
-                fy = force * dy / dist
-                p1.apply_force(fx, fy)
-
-def handle_collisions(particles, collision_mode, time_limit=None):
-    start = time.time()
-    to_remove = set()
-    for i in range(len(particles)):
-        if time_limit and time.time() - start > time_limit:
-            break
-        if particles[i] in to_remove:
-            continue
-        for j in range(i+1, len(particles)):
+            batch = sorted_targets[lo:lo + BH_BATCH_SIZE]
+            index = qt.order[batch]
+            fx[index], fy[index] = qt.batched_forces(theta, G, softening, batch)
+    elif use_barnes_hut:
+        qt = build_quadtree(particles, backend, domain)
+        fx = particles.fx
+        fy = particles.fy
+        for i in (range(len(particles)) if targets is None else targets):
             if time_limit and time.time() - start > time_limit:
+                profiler.active.count("force_truncations")
                 break
-            if particles[j] in to_remove:
+            fx[i], fy[i] = qt.calculate_force(particles[i], theta, G, softening)
+    else:
+        brute_force_forces(particles.x, particles.y, particles.mass, G, softening,
+                           particles.fx, particles.fy, time_limit, targets, period)
+
+def find_collision_pairs(x, y, radius):
+    # Uniform-grid broad phase. With cells as wide as the largest diameter,
+    # overlapping particles share a cell or sit in adjacent cells, so each
+    # cell is tested against itself and a half stencil of four neighbours.
+    # Returns overlapping pairs (i, j) with i < j, sorted by i then j.
+    n = len(x)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cell_size = 2 * radius.max()
+    if cell_size <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cx = ((x - x.min()) / cell_size).astype(np.int64)
+    cy = ((y - y.min()) / cell_size).astype(np.int64)
+    # One spare column so the +1 neighbour never wraps onto the next row
+    columns = cx.max() + 2
+    keys = cy * columns + cx
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell_start, cell_count = np.unique(keys[order], return_index=True, return_counts=True)
+    cell_of = np.repeat(np.arange(len(cell_keys)), cell_count)
+    sorted_pos = np.arange(n)
+
+    # Same cell: each particle against the ones after it
+    counts = cell_start[cell_of] + cell_count[cell_of] - sorted_pos - 1
+    first = [np.repeat(sorted_pos, counts)]
+    second = [np.repeat(sorted_pos + 1, counts) + _ramp(counts)]
+    for dx, dy in ((1, 0), (-1, 1), (0, 1), (1, 1)):
+        neighbour_keys = cell_keys + dy * columns + dx
+        slot = np.minimum(np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+        found = cell_keys[slot] == neighbour_keys
+        counts = np.where(found, cell_count[slot], 0)[cell_of]
+        first.append(np.repeat(sorted_pos, counts))
+        second.append(np.repeat(cell_start[slot][cell_of], counts) + _ramp(counts))
+    a = np.concatenate(first)
+    b = np.concatenate(second)
+
+    # Narrow phase, in grid order for locality
+    profiler.active.count("pairs_tested", len(a))
+    hit = _overlaps(x[order], y[order], radius[order], a, b)
+    return _sorted_pairs(order[a[hit]], order[b[hit]], n)
+
+def periodic_collision_pairs(x, y, radius, box):
+    # Minimum-image broad phase: particles within reach of an edge get
+    # shifted copies on the far side, and pairs found with a copy map back
+    # to the original indices. Same output as find_collision_pairs.
+    n = len(x)
+    min_x, min_y, size = box
+    reach = 2 * radius.max() if n else 0.0
+    index = [np.arange(n)]
+    copies_x = [x]
+    copies_y = [y]
+    for sx in (-1, 0, 1):
+        for sy in (-1, 0, 1):
+            if sx == sy == 0:
                 continue
-            if particles[i].collides_with(particles[j]):
-                if collision_mode == MERGE:
-                    particles[i].merge_with(particles[j])
-                    to_remove.add(particles[j])
-                elif collision_mode == ELASTIC:
-                    particles[i].elastic_collide(particles[j])
-                elif collision_mode == INELASTIC:
-                    particles[i].inelastic_collide(particles[j])
-    # Remove merged particles
-    particles[:] = [p for p in particles if p not in to_remove]
-
-def generate_particles(count, center_x=WIDTH/2, center_y=HEIGHT/2, spread=100):
-    particles = []
-    for _ in range(count):
-        x = center_x + random.uniform(-spread, spread)
-        y = center_y + random.uniform(-spread, spread)
-        vx = random.uniform(-50, 50)
-        vy = random.uniform(-50, 50)
-        mass = random.uniform(0.5, 2.0)
-        radius = mass * 5  # Scale radius with mass
-        particles.append(Particle(x, y, vx, vy, mass, radius))
-    return particles
+            cx = x + sx * size
+            cy = y + sy * size
+            near = np.flatnonzero((cx > min_x - reach) & (cx < min_x + size + reach) &
+                                  (cy > min_y - reach) & (cy < min_y + size + reach))
+            index.append(near)
+            copies_x.append(cx[near])
+            copies_y.append(cy[near])
+    index = np.concatenate(index)
+    i, j = find_collision_pairs(np.concatenate(copies_x), np.concatenate(copies_y), radius[index])
+    i = index[i]
+    j = index[j]
+    # Two copies can meet too; drop duplicates and a particle meeting itself
+    key = np.unique(np.minimum(i, j) * n + np.maximum(i, j))
+    i = key // n
+    j = key % n
+    distinct = i != j
+    return i[distinct], j[distinct]
+
+def tree_collision_pairs(tree, x, y, radius):
+    # Broad phase against an existing LinearQuadtree instead of a new grid.
+    # The tree may predate the current positions: node boxes are refitted to
+    # them, so the candidates stay exact without rebuilding.
+    n = len(x)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    order = tree.order
+    boxes = tree.node_boxes(x[order], y[order], radius[order])
+    i, s = tree.find_neighbours(x, y, radius, boxes)
+    j = order[s]
+    later = j > i
+    i = i[later]
+    j = j[later]
+    profiler.active.count("pairs_tested", len(i))
+    hit = _overlaps(x, y, radius, i, j)
+    return _sorted_pairs(i[hit], j[hit], n)
+
+def _overlaps(x, y, radius, i, j):
+    dx = x[j] - x[i]
+    dy = y[j] - y[i]
+    reach = radius[i] + radius[j]
+    return dx*dx + dy*dy < reach*reach
+
+def _sorted_pairs(i, j, n):
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    pair_order = np.argsort(i * n + j)
+    return i[pair_order], j[pair_order]
+
+def _separation(x, y, i, j, period):
+    dx = x[j] - x[i]
+    dy = y[j] - y[i]
+    if period is not None:
+        dx -= period * np.round(dx / period)
+        dy -= period * np.round(dy / period)
+    return dx, dy
+
+def resolve_impulses(particles, i, j, restitution, period=None):
+    # Impulse response of Particle.inelastic_collide (restitution 1 is
+    # elastic), applied pair by pair so that elastic contacts conserve
+    # energy however many partners a particle has. Pairs already moving
+    # apart get no impulse, so overlapping particles separate instead of
+    # being bounced back together every frame. Those are dropped up front;
+    # a pair that only starts approaching through another pair's impulse
+    # this frame is left for the next frame, which is where this differs
+    # from the sequential particle.resolve_pairs. The rest are applied in
+    # rounds: a pair is ready once it is the next unresolved pair of both
+    # its particles, so no particle appears twice in a round and each
+    # particle sees its pairs in order, with the velocities its earlier
+    # pairs left behind. Only pairs that just became some particle's next
+    # pair are checked, so a round costs as much as its own pairs.
+    x, y, vx, vy, mass = particles.x, particles.y, particles.vx, particles.vy, particles.mass
+    dx, dy = _separation(x, y, i, j, period)
+    dist = np.sqrt(dx*dx + dy*dy)
+    # Avoid division by zero
+    approaching = (dist > 0) & ((vx[j] - vx[i]) * dx + (vy[j] - vy[i]) * dy < 0)
+    i, j, dx, dy, dist = i[approaching], j[approaching], dx[approaching], dy[approaching], dist[approaching]
+    if not len(i):
+        return
+    nx = dx / dist
+    ny = dy / dist
+    # Each particle's pairs in order: incident[start[p]:end[p]]
+    n = len(particles)
+    ends = np.concatenate((i, j))
+    pair = np.concatenate((np.arange(len(i)), np.arange(len(i))))
+    incident = pair[np.lexsort((pair, ends))]
+    end = np.cumsum(np.bincount(ends, minlength=n))
+    start = end - np.bincount(ends, minlength=n)
+    position = start.copy()  # Next unresolved pair of each particle
+
+    def next_pair(p):
+        return np.where(position[p] < end[p], incident[np.minimum(position[p], len(incident) - 1)], -1)
+
+    candidates = np.unique(next_pair(np.unique(ends)))
+    while len(candidates):
+        candidates = candidates[candidates >= 0]
+        batch = candidates[(next_pair(i[candidates]) == candidates) &
+                           (next_pair(j[candidates]) == candidates)]
+        profiler.active.count("collision_rounds")
+        a, b = i[batch], j[batch]
+        ux, uy = nx[batch], ny[batch]
+        # Earlier pairs in this frame may have turned this one around
+        closing = np.minimum((vx[b] - vx[a]) * ux + (vy[b] - vy[a]) * uy, 0)
+        impulse = (1 + restitution) * closing / (1/mass[a] + 1/mass[b])
+        vx[a] += impulse * ux / mass[a]
+        vy[a] += impulse * uy / mass[a]
+        vx[b] -= impulse * ux / mass[b]
+        vy[b] -= impulse * uy / mass[b]
+        position[a] += 1
+        position[b] += 1
+        candidates = np.unique(next_pair(np.concatenate((a, b))))
+
+def resolve_merges(particles, i, j, period=None):
+    # Survival rule of the sequential pass: walking i upwards, a live
+    # particle absorbs every live partner. A particle therefore survives iff
+    # none of its lower-index partners survive, and a non-survivor is absorbed
+    # by its lowest surviving partner. Survival is settled in rounds, then all
+    # absorptions are applied at once, conserving mass, momentum and centre
+    # of mass (of the nearest images, with a period). Unlike the sequential
+    # pass, absorbers neither grow nor move until the end, so only the
+    # pairs overlapping at the start of the frame merge; the rest follow in
+    # later frames. Returns the indices of absorbed particles.
+    n = len(particles)
+    UNDECIDED, SURVIVES, ABSORBED = 0, 1, 2
+    state = np.zeros(n, dtype=np.int8)
+    while True:
+        undecided = state == UNDECIDED
+        if not undecided[j].any():
+            break
+        has_survivor = np.bincount(j, state[i] == SURVIVES, n) > 0
+        has_pending = np.bincount(j, state[i] == UNDECIDED, n) > 0
+        state[undecided & has_survivor] = ABSORBED
+        state[undecided & ~has_survivor & ~has_pending] = SURVIVES
+    take = state[i] == SURVIVES
+    # Pairs are sorted by i, so the first pair naming j has its lowest survivor
+    absorbed, first = np.unique(j[take], return_index=True)
+    absorber = i[take][first]
+
+    x, y, vx, vy = particles.x, particles.y, particles.vx, particles.vy
+    mass, radius = particles.mass, particles.radius
+    m = mass[absorbed]
+    total = mass + np.bincount(absorber, m, n)
+    dx, dy = _separation(x, y, absorber, absorbed, period)
+    x += np.bincount(absorber, m * dx, n) / total
+    y += np.bincount(absorber, m * dy, n) / total
+    vx[:] = (vx * mass + np.bincount(absorber, m * vx[absorbed], n)) / total
+    vy[:] = (vy * mass + np.bincount(absorber, m * vy[absorbed], n)) / total
+    radius[:] = np.sqrt(radius**2 + np.bincount(absorber, radius[absorbed]**2, n))  # Approximate volume conservation
+    mass[:] = total
+    return absorbed
+
+def handle_collisions(particles, collision_mode, tree=None, domain=None):
+    period = domain.period if domain is not None else None
+    if period is not None:
+        i, j = periodic_collision_pairs(particles.x, particles.y, particles.radius, domain.box)
+    elif tree is not None:
+        i, j = tree_collision_pairs(tree, particles.x, particles.y, particles.radius)
+    else:
+        i, j = find_collision_pairs(particles.x, particles.y, particles.radius)
+    profiler.active.count("collisions_resolved", len(i))
+    if collision_mode == MERGE:
+        # Remove merged particles
+        particles.remove_many(resolve_merges(particles, i, j, period))
+    elif collision_mode == ELASTIC:
+        resolve_impulses(particles, i, j, 1.0, period)
+    elif collision_mode == INELASTIC:
+        resolve_impulses(particles, i, j, INELASTIC_RESTITUTION, period)
+
+def generate_particles(count, center_x=WIDTH/2, center_y=HEIGHT/2, spread=100, seed=None):
+    return scenarios.generate("uniform", count, seed, center_x=center_x, center_y=center_y,
+                              spread=spread)
 
 def update_particles(particles, dt):
-    for p in particles:
-        p.update(dt)
+    # Semi-implicit Euler over whole arrays: a = F/m, then v, then x
+    kick(particles, dt)
+    drift(particles, dt)
+
+# Integrators selectable by name, e.g. from the headless runner
+INTEGRATORS = {
+    "euler": EulerIntegrator,
+    "leapfrog": LeapfrogIntegrator,
+    "block": BlockTimestepIntegrator,
+}
+
+def step(particles, dt, collision_mode, theta=THETA, time_limit=None, pool=None,
+         tree_cache=None, integrator=None, scheduler=None, method=FORCE_METHOD, domain=None,
+         softening=SOFTENING):
+    # One frame with a single spatial index: the Morton tree built for gravity
+    # also answers the collision queries after the particles have moved.
+    # With an IncrementalQuadtree as tree_cache the tree is refitted rather
+    # than rebuilt from scratch. The integrator decides when, and for which
+    # particles, forces are evaluated; collisions use the last tree built.
+    # method picks the force solver. For Barnes-Hut a ForceScheduler, if
+    # given, spends time_limit on forces and picks theta itself (its own
+    # softening applies too). A Domain confines positions before every force
+    # pass, fixes the tree root box, and after the step handles escaped
+    # particles and the far field.
+
+    # Stages are reported to profiler.active; "integrate" is the integrator's
+    # own work with the nested tree and force stages excluded.
+    trees = []
+    stats = profiler.active
+
+    def forces(targets=None):
+        with stats.stage("tree"):
+            if domain is not None:
+                domain.confine(particles)
+                box, period = domain.tree_box(), domain.period
+            else:
+                box, period = None, None
+            if tree_cache is not None:
+                tree = tree_cache.update(particles, box, period)
+            else:
+                tree = build_quadtree(particles, "linear", domain)
+        trees.append(tree)
+        with stats.stage("forces"):
+            if scheduler is not None and method == "barnes_hut":
+                scheduler.calculate(particles, tree, time_limit, targets, pool)
+            else:
+                calculate_forces(particles, time_limit=time_limit, theta=theta, pool=pool,
+                                 tree=tree, targets=targets, method=method, domain=domain,
+                                 softening=softening)
+
+    if integrator is None:
+        integrator = EulerIntegrator()
+    with stats.stage("integrate"):
+        integrator.advance(particles, dt, forces)
+        if domain is not None:
+            domain.far_field(particles, dt, softening)
+            domain.confine(particles)
+            if domain.remove_escaped(particles):
+                trees.clear()  # Indices changed
+    with stats.stage("collisions"):
+        handle_collisions(particles, collision_mode, tree=trees[-1] if trees else None,
+                          domain=domain)
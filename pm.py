@@ -0,0 +1,217 @@
+import numpy as np
+
+from constants import P3M_CUTOFF, P3M_FIRST_LEAVES, P3M_PAIR_BATCH, P3M_SPLIT, PM_GRID
+from linear_quadtree import LinearQuadtree, _ramp, root_box
+
+# Particle-mesh gravity. Masses are deposited on a grid with cloud-in-cell
+# weights, convolved by FFT with the force kernel sampled at grid offsets,
+# and the mesh field is interpolated back with the same weights. The kernel
+# is the simulation's own softened 1/r^2 force, not the 2D (logarithmic)
+# Poisson Green's function, so the FFT convolution replaces a Poisson
+# solve. Open boundaries use Hockney-Eastwood zero padding to twice the
+# grid; periodic ones wrap the kernel to the nearest image.
+#
+# With p3m=True the mesh only carries the smooth long-range part
+#     force(r) = erf(r / 2rs) / r^2 - exp(-r^2 / 4rs^2) / (rs sqrt(pi) r)
+# (split radius rs = P3M_SPLIT cells), and pairs closer than P3M_CUTOFF * rs
+# add the exact softened force minus that part, so close encounters are
+# as accurate as brute force. Those pairs come from a range query on the
+# LinearQuadtree the step already built for the current positions (or a
+# new one); a periodic mesh uses a wrapped cell grid instead, since the
+# tree query does not see images across the boundary.
+
+def erf(x):
+    # Abramowitz & Stegun 7.1.26, absolute error below 1.5e-7
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return sign * (1 - poly * np.exp(-x * x))
+
+def long_range(r, split):
+    # Long-range force per unit G*m*m' divided by r, so that the force
+    # vector is G m m' d * long_range(|d|); finite at r = 0
+    r = np.asarray(r, dtype=float)
+    small = r < 1e-3 * split
+    safe = np.where(small, split, r)
+    value = (erf(safe / (2 * split)) / safe**2 -
+             np.exp(-safe**2 / (4 * split**2)) / (split * np.sqrt(np.pi) * safe)) / safe
+    return np.where(small, 1 / (6 * np.sqrt(np.pi) * split**3), value)
+
+def _kernel(size, h, softening, split):
+    # Force per unit G*m*m' on a particle from a unit mass one grid offset
+    # away, sampled on the (padded) FFT grid; offsets wrap to the nearest
+    # image, which for the padded grid never aliases
+    offset = np.arange(size)
+    offset = np.where(offset < size // 2, offset, offset - size) * h
+    dx, dy = np.meshgrid(offset, offset, indexing="ij")
+    r_sq = dx*dx + dy*dy
+    if split:
+        scale = long_range(np.sqrt(r_sq), split)
+    else:
+        scale = 1 / (r_sq + softening) ** 1.5
+    # The mesh adds sum_c' rho(c') K(c - c'), and the source sits at -d from the target
+    return np.fft.rfft2(-dx * scale), np.fft.rfft2(-dy * scale)
+
+def pm_forces(x, y, mass, G, softening, cells=PM_GRID, periodic=False, p3m=False,
+              box=None, tree=None):
+    # box: (min_x, min_y, size) of the mesh; required for periodic domains,
+    # otherwise the particles' root box
+    # tree: optional LinearQuadtree over x, y for the P3M pair search
+    n = len(x)
+    fx = np.zeros(n)
+    fy = np.zeros(n)
+    if n < 2:
+        return fx, fy
+    if box is None:
+        if periodic:
+            raise ValueError("a periodic mesh needs the domain box")
+        box = root_box(x, y)
+    min_x, min_y, size = box
+    if periodic:
+        h = size / cells
+        u = (x - min_x) / h - 0.5
+        v = (y - min_y) / h - 0.5
+        grid = cells
+    else:
+        # One spare cell on each side keeps every CIC stencil on the grid
+        h = size / (cells - 2)
+        u = (x - min_x) / h + 0.5
+        v = (y - min_y) / h + 0.5
+        grid = 2 * cells
+    split = P3M_SPLIT * h if p3m else 0.0
+
+    i0 = np.floor(u).astype(np.int64)
+    j0 = np.floor(v).astype(np.int64)
+    fu = u - i0
+    fv = v - j0
+    stencil = []
+    for di, wu in ((0, 1 - fu), (1, fu)):
+        for dj, wv in ((0, 1 - fv), (1, fv)):
+            stencil.append(((i0 + di) % grid, (j0 + dj) % grid, wu * wv))
+    density = np.zeros(grid * grid)
+    for i, j, w in stencil:
+        density += np.bincount(i * grid + j, w * mass, grid * grid)
+    density_k = np.fft.rfft2(density.reshape(grid, grid))
+    kernel_x, kernel_y = _kernel(grid, h, softening, split)
+    field_x = np.fft.irfft2(density_k * kernel_x, (grid, grid))
+    field_y = np.fft.irfft2(density_k * kernel_y, (grid, grid))
+    for i, j, w in stencil:
+        fx += w * field_x[i, j]
+        fy += w * field_y[i, j]
+    fx *= G * mass
+    fy *= G * mass
+
+    if p3m:
+        if periodic:
+            sx, sy = _periodic_short_range(x, y, mass, G, softening, split, box)
+        else:
+            if tree is None:
+                tree = LinearQuadtree(x, y, mass)
+            sx, sy = _short_range(tree, x, y, mass, G, softening, split)
+        fx += sx
+        fy += sy
+    return fx, fy
+
+def _correction(sx, sy, smass, G, softening, split, cutoff, pair, other, period=None):
+    # Exact minus mesh force on each pair's first particle, for pairs closer
+    # than the cutoff. The particle itself has ddx = ddy = 0 and contributes
+    # nothing.
+    ddx = sx[other] - sx[pair]
+    ddy = sy[other] - sy[pair]
+    if period is not None:
+        ddx -= period * np.round(ddx / period)
+        ddy -= period * np.round(ddy / period)
+    r_sq = ddx*ddx + ddy*ddy
+    near = r_sq < cutoff * cutoff
+    pair, other, ddx, ddy, r_sq = pair[near], other[near], ddx[near], ddy[near], r_sq[near]
+    scale = G * smass[pair] * smass[other] * (
+        1 / (r_sq + softening) ** 1.5 - long_range(np.sqrt(r_sq), split))
+    return pair, scale * ddx, scale * ddy
+
+def _short_range(tree, x, y, mass, G, softening, split):
+    # Pairs from a batched range query on the tree, against node boxes
+    # refitted to the current positions. Each leaf queries once with its box
+    # grown by the cutoff, and every particle in it takes the leaf's
+    # candidates. Leaves go in tree order, so neighbouring chunks see similar
+    # densities, and each chunk is sized from the previous one's pairs per
+    # leaf (growing at most twofold) to stay near P3M_PAIR_BATCH pairs:
+    # dense clusters only cost time.
+    n = len(x)
+    cutoff = P3M_CUTOFF * split
+    order = tree.order
+    sx, sy, smass = x[order], y[order], mass[order]
+    min_x, max_x, min_y, max_y = boxes = tree.node_boxes(sx, sy, np.zeros(n))
+    leaves = np.flatnonzero((tree.child_count == 0) & (tree.end > tree.start))
+    leaves = leaves[np.argsort(tree.start[leaves])]
+    center_x = (min_x[leaves] + max_x[leaves]) / 2
+    center_y = (min_y[leaves] + max_y[leaves]) / 2
+    reach = np.maximum(max_x[leaves] - min_x[leaves], max_y[leaves] - min_y[leaves]) / 2 + cutoff
+    sfx = np.zeros(n)
+    sfy = np.zeros(n)
+    first = 0
+    chunk = P3M_FIRST_LEAVES
+    while first < len(leaves):
+        last = min(first + chunk, len(leaves))
+        query, other = tree.find_neighbours(center_x[first:last], center_y[first:last],
+                                            reach[first:last], boxes)
+        leaf = leaves[first:last][query]
+        counts = tree.end[leaf] - tree.start[leaf]
+        pair = np.repeat(tree.start[leaf], counts) + _ramp(counts)
+        other = np.repeat(other, counts)
+        lo = tree.start[leaves[first]]
+        hi = tree.end[leaves[last - 1]]
+        chunk = max(1, min(2 * (last - first), P3M_PAIR_BATCH * (last - first) // max(len(pair), 1)))
+        pair, px, py = _correction(sx, sy, smass, G, softening, split, cutoff, pair, other)
+        sfx[lo:hi] += np.bincount(pair - lo, px, hi - lo)
+        sfy[lo:hi] += np.bincount(pair - lo, py, hi - lo)
+        first = last
+    fx = np.empty(n)
+    fy = np.empty(n)
+    fx[order] = sfx
+    fy[order] = sfy
+    return fx, fy
+
+def _periodic_short_range(x, y, mass, G, softening, split, box):
+    # The same correction on a wrapped grid of cells at least a cutoff wide:
+    # each particle visits the 3x3 block around its cell, with minimum-image
+    # separations, in chunks of bounded pair count.
+    n = len(x)
+    cutoff = P3M_CUTOFF * split
+    min_x, min_y, size = box
+    side = int(size / cutoff)
+    # A 3x3 block must not visit a cell twice; at side 3 it already covers
+    # the whole box
+    side = max(side, 3)
+    ix = np.clip(((x - min_x) / size * side).astype(np.int64), 0, side - 1)
+    iy = np.clip(((y - min_y) / size * side).astype(np.int64), 0, side - 1)
+    cell = ix * side + iy
+    order = np.argsort(cell, kind="stable")
+    sx, sy, smass = x[order], y[order], mass[order]
+    cell_start = np.searchsorted(cell[order], np.arange(side * side))
+    cell_end = np.searchsorted(cell[order], np.arange(side * side), side="right")
+
+    neighbours = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour = (ix[order] + dx) % side * side + (iy[order] + dy) % side
+            neighbours.append((neighbour, cell_end[neighbour] - cell_start[neighbour]))
+    work = np.cumsum(sum(counts for _, counts in neighbours))
+    bounds = np.searchsorted(work, np.arange(0, work[-1], P3M_PAIR_BATCH), side="right")
+    bounds = np.unique(np.concatenate([[0], bounds, [n]]))
+
+    sfx = np.zeros(n)
+    sfy = np.zeros(n)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        part = np.arange(lo, hi)
+        for neighbour, counts in neighbours:
+            pair = np.repeat(part, counts[lo:hi])
+            other = np.repeat(cell_start[neighbour[lo:hi]], counts[lo:hi]) + _ramp(counts[lo:hi])
+            pair, px, py = _correction(sx, sy, smass, G, softening, split, cutoff, pair, other, size)
+            sfx[lo:hi] += np.bincount(pair - lo, px, hi - lo)
+            sfy[lo:hi] += np.bincount(pair - lo, py, hi - lo)
+    fx = np.empty(n)
+    fy = np.empty(n)
+    fx[order] = sfx
+    fy[order] = sfy
+    return fx, fy
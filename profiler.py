@@ -0,0 +1,142 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from constants import PROFILE_WINDOW
+
+# Instrumented code reports through the module-level `active` profiler:
+#     with profiler.active.stage("forces"): ...
+#     profiler.active.count("nodes_visited", n)
+# By default it is a NullProfiler whose methods do nothing, so disabled
+# instrumentation costs one attribute lookup and an empty call per site.
+
+STAGES = ("tree", "forces", "integrate", "collisions", "draw")
+COUNTERS = ("nodes_visited", "pairs_tested", "collisions_resolved", "collision_rounds",
+            "force_truncations")
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class NullProfiler:
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, amount=1):
+        pass
+
+    def end_frame(self):
+        pass
+
+class _Stage:
+    # Records exclusive time: time spent in nested stages is charged to them,
+    # not to the enclosing stage
+    __slots__ = ("profiler", "name", "start", "child")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.child = 0.0
+        self.profiler.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        total = time.perf_counter() - self.start
+        stack = self.profiler.stack
+        stack.pop()
+        if stack:
+            stack[-1].child += total
+        current = self.profiler.current
+        current[self.name] = current.get(self.name, 0.0) + total - self.child
+        return False
+
+class FrameProfiler:
+    # Per-frame stage times and counters with rolling windows for
+    # percentiles. With record=True every frame is also kept for dump().
+    enabled = True
+
+    def __init__(self, window=PROFILE_WINDOW, record=False):
+        self.window = window
+        self.record = record
+        self.stack = []
+        self.current = {}
+        self.history = {}
+        self.trace = []
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def count(self, name, amount=1):
+        self.current[name] = self.current.get(name, 0) + amount
+
+    def end_frame(self):
+        frame = self.current
+        self.current = {}
+        with self.lock:
+            for name in frame:
+                if name not in self.history:
+                    self.history[name] = deque(maxlen=self.window)
+            # A stage or counter that did not occur this frame counts as zero
+            for name, values in self.history.items():
+                values.append(frame.get(name, 0))
+            self.frames += 1
+        if self.record:
+            frame["frame"] = self.frames
+            self.trace.append(frame)
+
+    def percentiles(self, name, q=(50, 95, 99)):
+        with self.lock:
+            values = list(self.history.get(name, ()))
+        if not values:
+            return [0.0] * len(q)
+        return list(np.percentile(values, q))
+
+    def summary_lines(self):
+        # One line per stage seen so far (ms) and per counter (per frame)
+        lines = []
+        for name in STAGES:
+            if name in self.history:
+                p50, p95, p99 = (v * 1000 for v in self.percentiles(name))
+                lines.append(f"{name}: p50 {p50:.2f} p95 {p95:.2f} p99 {p99:.2f} ms")
+        for name in COUNTERS:
+            if name in self.history:
+                p50, p95, _ = self.percentiles(name)
+                lines.append(f"{name}: p50 {p50:.0f} p95 {p95:.0f}")
+        return lines
+
+    def dump(self, path):
+        # JSON list of frames for *.json, CSV with one row per frame otherwise
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(self.trace, f)
+            return
+        present = set().union(*self.trace) if self.trace else set()
+        columns = ["frame"] + [name for name in STAGES + COUNTERS if name in present]
+        # Anything counted under a name not listed above still gets a column
+        columns += sorted(present - set(columns))
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, restval=0)
+            writer.writeheader()
+            writer.writerows(self.trace)
+
+active = NullProfiler()
+
+def activate(profiler):
+    global active
+    active = profiler
@@ -0,0 +1,76 @@
+import numpy as np
+import pygame
+
+from constants import LOD_PIXELS, PIXEL_RADIUS
+from linear_quadtree import _ramp
+
+SQRT_HALF = 0.5 ** 0.5  # Node half-diagonal per cell size
+
+def draw_particles(screen, camera, x, y, radius, color):
+    # Transform every particle in one array operation and cull with masks.
+    # Particles smaller than PIXEL_RADIUS on screen are written straight into
+    # the pixel array; only the rest fall back to pygame.draw.circle.
+    width, height = screen.get_size()
+    sx, sy = camera.world_to_screen_array(x, y)
+    r = radius * camera.zoom
+    visible = (sx + r >= 0) & (sx - r < width) & (sy + r >= 0) & (sy - r < height)
+
+    dots = visible & (r < PIXEL_RADIUS) & (sx >= 0) & (sx < width) & (sy >= 0) & (sy < height)
+    if dots.any():
+        pixels = pygame.surfarray.pixels3d(screen)
+        pixels[sx[dots].astype(np.intp), sy[dots].astype(np.intp)] = color[dots]
+        del pixels  # Unlock the surface
+
+    circles = np.flatnonzero(visible & (r >= PIXEL_RADIUS))
+    for cx, cy, cr, c in zip(sx[circles].astype(int).tolist(), sy[circles].astype(int).tolist(),
+                             r[circles].astype(int).tolist(), color[circles].tolist()):
+        pygame.draw.circle(screen, c, (cx, cy), cr)
+
+def draw_lod(screen, camera, x, y, radius, color, nodes):
+    # Level-of-detail drawing from a snapshot published with its quadtree
+    # (particles in tree order). The tree is walked top-down one level at a
+    # time: nodes off screen are culled, nodes smaller than LOD_PIXELS on
+    # screen become one splat at their centre of mass, and leaves that are
+    # still large draw their particles. The work follows the number of
+    # visible pixels rather than the particle count.
+    width, height = screen.get_size()
+    pad = nodes["max_radius"] * camera.zoom
+    frontier = np.zeros(1, dtype=np.int64)
+    splats = []
+    leaves = []
+    while len(frontier):
+        sx, sy = camera.world_to_screen_array(nodes["cell_x"][frontier], nodes["cell_y"][frontier])
+        size = nodes["cell_size"][frontier] * camera.zoom
+        reach = size / 2 + pad
+        visible = ((sx + reach >= 0) & (sx - reach < width) & (sy + reach >= 0) &
+                   (sy - reach < height) & (nodes["end"][frontier] > nodes["start"][frontier]))
+        frontier = frontier[visible]
+        small = size[visible] < LOD_PIXELS
+        splats.append(frontier[small])
+        frontier = frontier[~small]
+        leaf = nodes["child_count"][frontier] == 0
+        leaves.append(frontier[leaf])
+        parents = frontier[~leaf]
+        frontier = (nodes["first_child"][parents][:, None] + np.arange(4)).ravel()
+
+    leaves = np.concatenate(leaves)
+    counts = nodes["end"][leaves] - nodes["start"][leaves]
+    members = np.repeat(nodes["start"][leaves], counts) + _ramp(counts)
+    draw_particles(screen, camera, x[members], y[members], radius[members], color[members])
+
+    # Splats are drawn like particles that cover the node and the particles
+    # reaching out of it. The shade is the expected share of the node's
+    # cell its particles would have covered (at least a pixel each, as
+    # draw_particles does), so dense nodes look like the full drawing and
+    # sparse ones fade with their density.
+    splats = np.concatenate(splats)
+    if len(splats):
+        cell = nodes["cell_size"][splats]
+        reach = cell * SQRT_HALF + nodes["max_radius"]
+        area = np.maximum((cell * camera.zoom) ** 2, 1.0)
+        dot = max(np.pi * (nodes["max_radius"] * camera.zoom) ** 2, 1.0)
+        count = nodes["end"][splats] - nodes["start"][splats]
+        coverage = 1 - np.exp(-count * dot / area)
+        shade = (nodes["color"][splats] * coverage[:, None]).astype(np.uint8)
+        draw_particles(screen, camera, nodes["center_x"][splats], nodes["center_y"][splats],
+                       reach, shade)
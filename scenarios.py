@@ -0,0 +1,106 @@
+import random
+
+import numpy as np
+
+from constants import BLUE, G, HEIGHT, RED, SOFTENING, WHITE, WIDTH
+from particle import ParticleSystem
+
+# Initial conditions generated as whole arrays from a NumPy Generator.
+# Velocities follow from the simulation's own G, which is tiny, so the
+# self-gravitating families barely move unless a larger G is passed in.
+
+def _system(x, y, vx, vy, mass, radius, color=WHITE):
+    particles = ParticleSystem(max(len(x), 1))
+    particles.add_many(x, y, vx, vy, mass, radius, color)
+    return particles
+
+def _rng(seed):
+    # Without a seed, draw one from the random module so random.seed()
+    # still makes runs reproducible
+    if seed is None:
+        seed = random.getrandbits(64)
+    return np.random.default_rng(seed)
+
+def uniform_box(count, rng, center_x=WIDTH/2, center_y=HEIGHT/2, spread=100):
+    # The original spawn distribution: uniform square, random velocities,
+    # radius scaled with mass
+    x = center_x + rng.uniform(-spread, spread, count)
+    y = center_y + rng.uniform(-spread, spread, count)
+    vx = rng.uniform(-50, 50, count)
+    vy = rng.uniform(-50, 50, count)
+    mass = rng.uniform(0.5, 2.0, count)
+    return _system(x, y, vx, vy, mass, mass * 5)
+
+def plummer(count, rng, center_x=WIDTH/2, center_y=HEIGHT/2, scale=50, mass=1.0,
+            radius=5.0, G=G):
+    # Plummer sphere projected onto the plane. Radii by inverting the
+    # cumulative mass profile (cut at 99.9% of the mass), speeds by
+    # rejection sampling the isotropic distribution function (Aarseth,
+    # Henon & Wielen 1974); the z components are dropped.
+    u = rng.uniform(0, 0.999, count)
+    r = scale / np.sqrt(u ** (-2 / 3) - 1)
+    x, y = _project(rng, r)
+
+    q = np.empty(count)
+    pending = np.arange(count)
+    while len(pending):
+        trial = rng.uniform(0, 1, len(pending))
+        accept = rng.uniform(0, 0.1, len(pending)) < trial**2 * (1 - trial**2) ** 3.5
+        q[pending[accept]] = trial[accept]
+        pending = pending[~accept]
+    escape = np.sqrt(2 * G * mass * count / scale) * (1 + (r / scale)**2) ** -0.25
+    vx, vy = _project(rng, q * escape)
+    return _system(center_x + x, center_y + y, vx, vy, np.full(count, mass),
+                   np.full(count, radius))
+
+def _project(rng, length):
+    # x, y of vectors with the given lengths and isotropic 3D directions
+    cos_theta = rng.uniform(-1, 1, len(length))
+    phi = rng.uniform(0, 2 * np.pi, len(length))
+    planar = length * np.sqrt(1 - cos_theta**2)
+    return planar * np.cos(phi), planar * np.sin(phi)
+
+def exponential_disk(count, rng, center_x=WIDTH/2, center_y=HEIGHT/2, scale=40, mass=1.0,
+                     radius=5.0, central_mass=0.0, spin=1, G=G, color=WHITE):
+    # Surface density ~ exp(-R/scale), i.e. R ~ Gamma(2, scale). Each
+    # particle orbits at the circular speed of the softened force from the
+    # mass inside its radius (plus central_mass); spin -1 turns clockwise.
+    R = rng.gamma(2.0, scale, count)
+    phi = rng.uniform(0, 2 * np.pi, count)
+    masses = np.full(count, mass)
+    order = np.argsort(R)
+    enclosed = np.empty(count)
+    enclosed[order] = np.cumsum(masses[order]) - masses[order]
+    speed = np.sqrt(G * (enclosed + central_mass) * R**2 / (R**2 + SOFTENING) ** 1.5)
+    x = center_x + R * np.cos(phi)
+    y = center_y + R * np.sin(phi)
+    vx = -spin * speed * np.sin(phi)
+    vy = spin * speed * np.cos(phi)
+    return _system(x, y, vx, vy, masses, np.full(count, radius), color)
+
+def colliding_galaxies(count, rng, center_x=WIDTH/2, center_y=HEIGHT/2, scale=40,
+                       separation=300, approach=20, mass=1.0, radius=5.0, G=G):
+    # Two counter-rotating exponential disks heading for an off-centre
+    # collision, one blue and one red
+    half = count // 2
+    offset = separation / 2
+    first = exponential_disk(half, rng, center_x - offset, center_y - offset / 4, scale,
+                             mass, radius, spin=1, G=G, color=BLUE)
+    second = exponential_disk(count - half, rng, center_x + offset, center_y + offset / 4,
+                              scale, mass, radius, spin=-1, G=G, color=RED)
+    first.vx += approach
+    second.vx -= approach
+    first.extend(second)
+    return first
+
+SCENARIOS = {
+    "uniform": uniform_box,
+    "plummer": plummer,
+    "disk": exponential_disk,
+    "galaxies": colliding_galaxies,
+}
+
+def generate(name, count, seed=None, **options):
+    if name not in SCENARIOS:
+        raise ValueError(f"unknown scenario {name!r}, expected one of {sorted(SCENARIOS)}")
+    return SCENARIOS[name](count, _rng(seed), **options)
@@ -0,0 +1,119 @@
+import time
+
+import numpy as np
+
+from constants import (ACCURACY_SAMPLES, BH_BATCH_SIZE, G, MAX_THETA, SCHEDULE_ORDER,
+                       SOFTENING, THETA, THETA_STEP)
+from physics import brute_force_forces, calculate_forces
+import profiler
+
+SCHEDULE_ORDERS = ("round_robin", "priority")
+
+class ForceScheduler:
+    # Time-budgeted force evaluation that coarsens before it skips. Each call
+    # first adapts theta from the throughput measured on the previous call:
+    # if refreshing every requested particle would overrun the budget, theta
+    # grows by THETA_STEP (up to max_theta), and it shrinks back towards the
+    # base theta once there is room. Particles are then refreshed in chunks,
+    # stalest first, until the budget runs out; whoever is left over keeps
+    # its previous forces and comes first next time, so nobody is starved.
+    # "round_robin" orders purely by staleness, "priority" by staleness times
+    # acceleration. Staleness lives in particles.force_age.
+    def __init__(self, order=SCHEDULE_ORDER, theta=THETA, max_theta=MAX_THETA,
+                 samples=ACCURACY_SAMPLES, seed=0, softening=SOFTENING):
+        if order not in SCHEDULE_ORDERS:
+            raise ValueError(f"unknown schedule order {order!r}, expected one of {SCHEDULE_ORDERS}")
+        self.order = order
+        self.base_theta = theta
+        self.theta = theta
+        self.max_theta = max_theta
+        self.samples = samples
+        self.softening = softening
+        self.rng = np.random.default_rng(seed)
+        self.rate = None  # Particles per second at the current theta
+        self.fresh_fraction = 1.0  # Share of requested particles refreshed last call
+        self.force_error = 0.0  # Median relative error of fx/fy over a sample, stale included
+
+    def schedule(self, particles, candidates):
+        age = particles.force_age[candidates].astype(float)
+        age[age < 0] = np.inf  # Never evaluated
+        if self.order == "priority":
+            accel = np.hypot(particles.fx[candidates], particles.fy[candidates]) / particles.mass[candidates]
+            with np.errstate(invalid="ignore"):
+                key = np.where(np.isinf(age), np.inf, (age + 1) * accel)
+        else:
+            key = age
+        # Stable, so equally stale particles keep index order and rotate
+        return candidates[np.argsort(-key, kind="stable")]
+
+    def adapt_theta(self, count, time_limit):
+        if self.rate is None or time_limit is None:
+            return
+        predicted = count / self.rate
+        if predicted > time_limit:
+            self.theta = min(self.theta * THETA_STEP, self.max_theta)
+        elif predicted * THETA_STEP < time_limit:
+            self.theta = max(self.theta / THETA_STEP, self.base_theta)
+
+    def calculate(self, particles, tree, time_limit=None, targets=None, pool=None):
+        n = len(particles)
+        candidates = np.arange(n) if targets is None else np.asarray(targets)
+        if len(candidates) == 0:
+            return
+        self.adapt_theta(len(candidates), time_limit)
+        start = time.perf_counter()
+        if pool is not None and targets is None and (
+                time_limit is None or (self.rate and n / self.rate <= time_limit)):
+            # Expected to fit: one parallel pass over everybody
+            calculate_forces(particles, theta=self.theta, pool=pool, tree=tree,
+                             softening=self.softening)
+            done = n
+            ordered = candidates
+        else:
+            ordered = self.schedule(particles, candidates)
+            done = 0
+            while done < len(ordered):
+                # The first chunk always runs so every call makes progress
+                if done and time_limit and time.perf_counter() - start > time_limit:
+                    profiler.active.count("force_truncations")
+                    break
+                chunk = ordered[done:done + BH_BATCH_SIZE]
+                calculate_forces(particles, theta=self.theta, tree=tree, targets=chunk,
+                                 softening=self.softening)
+                done += len(chunk)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            self.rate = done / elapsed
+
+        age = particles.force_age
+        waited = candidates[age[candidates] >= 0]
+        age[waited] += 1
+        age[ordered[:done]] = 0
+        self.fresh_fraction = done / len(candidates)
+        if self.samples:
+            self.force_error = self.measure_error(particles, candidates, tree.period)
+
+    def measure_error(self, particles, candidates, period=None):
+        # Stored forces of a few random particles against brute force
+        sample = self.rng.choice(candidates, min(self.samples, len(candidates)), replace=False)
+        exact_x = np.zeros(len(particles))
+        exact_y = np.zeros(len(particles))
+        brute_force_forces(particles.x, particles.y, particles.mass, G, self.softening,
+                           exact_x, exact_y, targets=sample, period=period)
+        exact = np.hypot(exact_x[sample], exact_y[sample])
+        error = np.hypot(particles.fx[sample] - exact_x[sample], particles.fy[sample] - exact_y[sample])
+        nonzero = exact > 0
+        if not nonzero.any():
+            return 0.0
+        return float(np.median(error[nonzero] / exact[nonzero]))
+
+    def report(self, particles):
+        age = particles.force_age
+        return {
+            "theta": self.theta,
+            "fresh_fraction": self.fresh_fraction,
+            "force_error": self.force_error,
+            "mean_age": float(age[age >= 0].mean()) if (age >= 0).any() else 0.0,
+            "max_age": int(age.max(initial=0)),
+            "never_evaluated": int((age < 0).sum()),
+        }
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from particle import ParticleSystem
+
+# Trajectory files: a 16-byte file header followed by any number of frames.
+# Each frame is a 32-byte header (magic, particle count, step, collision
+# mode) and the particle arrays back to back: x, y, vx, vy, fx, fy, mass,
+# radius as little-endian float64, then color as n*3 uint8, padded to 8 bytes. A
+# checkpoint is simply a trajectory holding one frame. Frames are only ever
+# appended, and a partially written last frame is ignored on reading.
+# The SHA-256 of a frame's bytes is the state hash used to check that two
+# runs (or backends) agree bit for bit. Forces are part of it: at small G
+# positions can agree to the last bit for many steps while the force
+# backends already differ.
+
+FILE_MAGIC = b"NBODYTRJ"
+FILE_VERSION = 2  # 2 added fx, fy
+FILE_HEADER = struct.Struct("<8sI4x")
+FRAME_MAGIC = b"FRM0"
+FRAME_HEADER = struct.Struct("<4s4xQQi4x")
+FRAME_FIELDS = ("x", "y", "vx", "vy", "fx", "fy", "mass", "radius")
+
+def _payload_size(count):
+    size = 8 * len(FRAME_FIELDS) * count + 3 * count
+    return (size + 7) // 8 * 8
+
+def _frame_parts(particles, step, collision_mode):
+    n = len(particles)
+    yield FRAME_HEADER.pack(FRAME_MAGIC, n, step, collision_mode)
+    for name in FRAME_FIELDS:
+        yield np.ascontiguousarray(getattr(particles, name), dtype="<f8").tobytes()
+    yield np.ascontiguousarray(particles.color, dtype=np.uint8).tobytes()
+    yield bytes(_payload_size(n) - (8 * len(FRAME_FIELDS) + 3) * n)
+
+def state_hash(particles, step, collision_mode):
+    # Hex SHA-256 of the frame that TrajectoryWriter would write
+    digest = hashlib.sha256()
+    for part in _frame_parts(particles, step, collision_mode):
+        digest.update(part)
+    return digest.hexdigest()
+
+class TrajectoryWriter:
+    # Streams frames to the end of a trajectory file, creating it if needed
+    def __init__(self, path):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            # Drop a frame left half-written by an interrupted run
+            complete = Trajectory(path).indexed
+            os.truncate(path, complete)
+        self.file = open(path, "ab")
+        if not exists:
+            self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        self.frames = 0
+
+    def write(self, particles, step, collision_mode):
+        for part in _frame_parts(particles, step, collision_mode):
+            self.file.write(part)
+        self.frames += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def _check_header(data, path):
+    if len(data) < FILE_HEADER.size:
+        raise ValueError(f"{path}: not a trajectory file")
+    magic, version = FILE_HEADER.unpack(data)
+    if magic != FILE_MAGIC:
+        raise ValueError(f"{path}: not a trajectory file")
+    if version != FILE_VERSION:
+        raise ValueError(f"{path}: unsupported trajectory version {version}")
+
+class Frame:
+    # One stored step. The arrays are read-only views into the memory map,
+    # so pages are only read from disk when they are touched.
+    def __init__(self, data, offset):
+        _, count, step, collision_mode = FRAME_HEADER.unpack_from(data, offset)
+        self.raw = data[offset:offset + FRAME_HEADER.size + _payload_size(count)]
+        self.count = count
+        self.step = step
+        self.collision_mode = collision_mode
+        pos = offset + FRAME_HEADER.size
+        for name in FRAME_FIELDS:
+            setattr(self, name, data[pos:pos + 8 * count].view("<f8"))
+            pos += 8 * count
+        self.color = data[pos:pos + 3 * count].reshape(count, 3)
+
+    def to_particles(self):
+        particles = ParticleSystem(max(self.count, 1))
+        particles.add_many(self.x, self.y, self.vx, self.vy, self.mass, self.radius, self.color)
+        particles.fx[:] = self.fx
+        particles.fy[:] = self.fy
+        return particles
+
+    def state_hash(self):
+        # Same as state_hash() of the particles this frame was written from
+        return hashlib.sha256(self.raw).hexdigest()
+
+class Trajectory:
+    # Random access to the frames of a trajectory file through np.memmap.
+    # Opening only reads the frame headers; refresh() picks up frames that
+    # were appended since.
+    def __init__(self, path):
+        self.path = path
+        self.offsets = []
+        self.indexed = FILE_HEADER.size
+        self.data = None
+        with open(path, "rb") as f:
+            _check_header(f.read(FILE_HEADER.size), path)
+        self.refresh()
+
+    def refresh(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, "rb") as f:
+            offset = self.indexed
+            while offset + FRAME_HEADER.size <= size:
+                f.seek(offset)
+                magic, count, _, _ = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+                if magic != FRAME_MAGIC:
+                    raise ValueError(f"{self.path}: corrupt frame at byte {offset}")
+                end = offset + FRAME_HEADER.size + _payload_size(count)
+                if end > size:
+                    break  # Still being written
+                self.offsets.append(offset)
+                offset = end
+            self.indexed = offset
+        if self.data is None or len(self.data) < self.indexed:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode="r", shape=(self.indexed,))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return Frame(self.data, self.offsets[index])
+
+def save_checkpoint(path, particles, step, collision_mode):
+    # Written next to the target and renamed, so a crash never leaves a
+    # half-written checkpoint behind
+    temp = path + ".tmp"
+    if os.path.exists(temp):
+        os.remove(temp)
+    with TrajectoryWriter(temp) as writer:
+        writer.write(particles, step, collision_mode)
+    os.replace(temp, path)
+
+def load_checkpoint(path):
+    # Returns (particles, step, collision_mode) from the last frame in path
+    trajectory = Trajectory(path)
+    if not len(trajectory):
+        raise ValueError(f"{path}: no complete frame")
+    frame = trajectory[-1]
+    return frame.to_particles(), frame.step, frame.collision_mode
@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from constants import DT, ELASTIC, FORCE_METHOD, FORCE_TIME_LIMIT, RECORD_EVERY
+from domain import Domain
+from linear_quadtree import IncrementalQuadtree
+from physics import step
+from scheduler import ForceScheduler
+import profiler
+
+# Quadtree node arrays published for level-of-detail rendering
+LOD_FIELDS = ("start", "end", "first_child", "child_count", "cell_x", "cell_y", "cell_size",
+              "total_mass", "center_x", "center_y")
+
+class Snapshot:
+    # Render-side copy of the particle state after one physics step. Given
+    # the quadtree for the current positions, the particles are stored in
+    # tree order and nodes holds its node arrays plus a mass-weighted mean
+    # color per node, so node ranges index the snapshot arrays directly.
+    # schedule is the ForceScheduler report for the same step, or None.
+    def __init__(self, capacity=0):
+        self.count = 0
+        self.step = 0
+        self.nodes = None
+        self.schedule = None
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.radius = np.zeros(capacity)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+
+    def fill(self, particles, step_count, tree=None, schedule=None):
+        n = len(particles)
+        if n > len(self.x):
+            capacity = max(n, 2 * len(self.x))
+            self.x = np.zeros(capacity)
+            self.y = np.zeros(capacity)
+            self.radius = np.zeros(capacity)
+            self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        if tree is None:
+            self.x[:n] = particles.x
+            self.y[:n] = particles.y
+            self.radius[:n] = particles.radius
+            self.color[:n] = particles.color
+            self.nodes = None
+        else:
+            self.x[:n] = tree.x
+            self.y[:n] = tree.y
+            self.radius[:n] = particles.radius[tree.order]
+            self.color[:n] = particles.color[tree.order]
+            self.nodes = {name: getattr(tree, name).copy() for name in LOD_FIELDS}
+            weighted = np.cumsum(tree.mass[:, None] * self.color[:n], axis=0)
+            weighted = np.concatenate((np.zeros((1, 3)), weighted))
+            start, end = tree.start, tree.end
+            total = np.where(tree.total_mass > 0, tree.total_mass, 1.0)
+            self.nodes["color"] = (weighted[end] - weighted[start]) / total[:, None]
+            self.nodes["max_radius"] = self.radius[:n].max()
+        self.count = n
+        self.step = step_count
+        self.schedule = schedule
+
+class PhysicsWorker(threading.Thread):
+    # Steps the simulation at a fixed dt on its own thread. The heavy work is
+    # NumPy, which releases the GIL, so the render loop keeps its frame rate.
+    # All changes to the particles go through submit() and are applied between
+    # steps. Each step is published into the back of two Snapshot buffers and
+    # the buffers are swapped; the renderer borrows the front one with
+    # acquire()/release() and never copies it. A step that would overwrite the
+    # buffer still being drawn is simply not published. Assigning a
+    # FrameProfiler to stats turns on per-step profiling. Forces get
+    # time_limit seconds per step through a ForceScheduler when method is
+    # Barnes-Hut. With lod set, snapshots also carry the quadtree refitted
+    # to the published positions (the next step's forces start from that
+    # same refit). While stats are enabled the scheduler report is computed
+    # here and published with the snapshot, since the particle buffers may be
+    # resized or compacted by the next step while the renderer reads it.
+    # With a TrajectoryWriter as recorder every record_every-th step is appended.
+    def __init__(self, particles, dt=DT, collision_mode=ELASTIC, pool=None,
+                 time_limit=FORCE_TIME_LIMIT):
+        super().__init__(daemon=True)
+        self.particles = particles
+        self.dt = dt
+        self.collision_mode = collision_mode
+        self.pool = pool
+        self.tree_cache = IncrementalQuadtree()
+        self.time_limit = time_limit
+        self.scheduler = ForceScheduler()
+        self.method = FORCE_METHOD
+        self.lod = False
+        self.domain = Domain()
+        self.commands = queue.Queue()
+        self.buffers = [Snapshot(), Snapshot()]
+        self.front = 0
+        self.reading = None
+        self.lock = threading.Lock()
+        self.running = True
+        self.steps = 0
+        self.steps_per_sec = 0.0
+        self.stats = profiler.NullProfiler()
+        self.recorder = None
+        self.record_every = RECORD_EVERY
+
+    def submit(self, command):
+        # command(particles) runs on the physics thread before the next step
+        self.commands.put(command)
+
+    def restore(self, particles, step_count):
+        # Replace the simulation state, e.g. with one from load_checkpoint
+        def command(p):
+            p.clear()
+            p.extend(particles)
+            self.steps = step_count
+        self.submit(command)
+
+    def acquire(self):
+        with self.lock:
+            self.reading = self.front
+            return self.buffers[self.front]
+
+    def release(self):
+        with self.lock:
+            self.reading = None
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def _publish(self):
+        with self.lock:
+            back = 1 - self.front
+            if self.reading == back:
+                return
+        tree = None
+        if self.lod and len(self.particles):
+            tree = self.tree_cache.update(self.particles, self.domain.tree_box(), self.domain.period)
+        schedule = None
+        if self.stats.enabled and self.method == "barnes_hut":
+            schedule = self.scheduler.report(self.particles)
+        self.buffers[back].fill(self.particles, self.steps, tree, schedule)
+        with self.lock:
+            self.front = back
+
+    def run(self):
+        start = time.perf_counter()
+        rate_start = start
+        rate_steps = 0
+        paced = 0  # Steps since start; self.steps may jump on restore
+        while self.running:
+            while not self.commands.empty():
+                self.commands.get()(self.particles)
+            stats = self.stats
+            profiler.activate(stats)
+            step(self.particles, self.dt, self.collision_mode, time_limit=self.time_limit,
+                 pool=self.pool, tree_cache=self.tree_cache, scheduler=self.scheduler,
+                 method=self.method, domain=self.domain)
+            stats.end_frame()
+            self.steps += 1
+            paced += 1
+            if self.recorder is not None and self.steps % self.record_every == 0:
+                self.recorder.write(self.particles, self.steps, self.collision_mode)
+            self._publish()
+
+            now = time.perf_counter()
+            rate_steps += 1
+            if now - rate_start >= 0.5:
+                self.steps_per_sec = rate_steps / (now - rate_start)
+                rate_start = now
+                rate_steps = 0
+            # Never run ahead of real time; when behind, just keep stepping
+            ahead = start + paced * self.dt - now
+            if ahead > 0:
+                time.sleep(ahead)
+            elif ahead < -1.0:
+                start = now - paced * self.dt